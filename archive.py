@@ -0,0 +1,130 @@
+import bisect
+import json
+import os
+from slack import atomic_write
+
+INDEX_INTERVAL = 256
+
+
+class Archive:
+    """Read access to an output directory written by slack.py, loading no more
+    of it than is asked for. The index of channels, people and bots is read
+    the first time one of them is needed, and a channel's messages only as
+    they are iterated over, one at a time. A sparse index of byte offsets
+    into each channel's file lets a time range be read without reading the
+    messages before it."""
+
+    def __init__(self, path):
+        self.path = path.rstrip("/")
+        self.index = None
+        self.offsets = {}
+
+    def load_index(self):
+        """Returns the archive's index.json, reading it the first time."""
+
+        if self.index is None:
+            with open(f"{self.path}/index.json") as f:
+                self.index = json.load(f)
+        return self.index
+
+    @property
+    def channels(self):
+        """Every channel in the archive by ID, without its messages."""
+
+        return self.load_index()["channels"]
+
+    @property
+    def people(self):
+        """Every user in the archive by ID."""
+
+        return self.load_index()["people"]
+
+    @property
+    def bots(self):
+        """Every bot in the archive by ID."""
+
+        return self.load_index().get("bots", {})
+
+    def downloaded(self):
+        """Returns the IDs of the channels whose messages have been
+        downloaded."""
+
+        return [channel_id for channel_id, channel in self.channels.items() if "message_count" in channel]
+
+    def name(self, channel_id):
+        """Returns a channel's readable name, falling back to its ID."""
+
+        channel = self.channels.get(channel_id, {})
+        return channel.get("readable_name") or channel.get("name") or channel_id
+
+    def messages(self, channel_id, since=None, until=None):
+        """Yields a channel's messages, oldest first, optionally only those
+        sent on or after since and before until, given as Slack timestamps.
+        Reading starts from the last indexed message before since, and stops
+        at the first message sent at or after until."""
+
+        path = f"{self.path}/channels/{channel_id}.jsonl"
+        if not os.path.exists(path):
+            return
+        since = float(since) if since is not None else None
+        until = float(until) if until is not None else None
+        offset = 0
+        if since is not None:
+            index = self.offset_index(channel_id)
+            position = bisect.bisect_left(index["ts"], since)
+            offset = index["offsets"][position - 1] if position else 0
+        with open(path, "rb") as f:
+            f.seek(offset)
+            for line in f:
+                message = json.loads(line)
+                ts = float(message["ts"])
+                if until is not None and ts >= until:
+                    return
+                if since is None or ts >= since:
+                    yield message
+
+    def load(self, channel_id, since=None, until=None):
+        """Loads a channel's messages, as messages() yields them."""
+
+        return list(self.messages(channel_id, since, until))
+
+    def offset_index(self, channel_id):
+        """Returns the sparse index of a channel's file: the timestamp and byte
+        offset of every INDEX_INTERVAL-th message. Indexes are kept in
+        offsets/ and made again whenever the channel's file has changed."""
+
+        stat = os.stat(f"{self.path}/channels/{channel_id}.jsonl")
+        key = [stat.st_size, stat.st_mtime_ns]
+        if (index := self.offsets.get(channel_id)) and index["key"] == key:
+            return index
+        index_path = f"{self.path}/offsets/{channel_id}.json"
+        try:
+            with open(index_path) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = None
+        if not index or index.get("key") != key or index.get("interval") != INDEX_INTERVAL:
+            index = build_offset_index(f"{self.path}/channels/{channel_id}.jsonl", key)
+            try:
+                os.makedirs(os.path.dirname(index_path), exist_ok=True)
+                with atomic_write(index_path) as f:
+                    json.dump(index, f)
+            except OSError:
+                pass
+        self.offsets[channel_id] = index
+        return index
+
+
+def build_offset_index(path, key):
+    """Reads through a channel's file to index the timestamp and byte offset
+    of every INDEX_INTERVAL-th message. Only those messages are parsed."""
+
+    timestamps, offsets = [], []
+    offset = 0
+    with open(path, "rb") as f:
+        for number, line in enumerate(f):
+            if number % INDEX_INTERVAL == 0:
+                timestamps.append(float(json.loads(line)["ts"]))
+                offsets.append(offset)
+            offset += len(line)
+    return {"key": key, "interval": INDEX_INTERVAL, "ts": timestamps, "offsets": offsets}
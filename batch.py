@@ -0,0 +1,179 @@
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
+import traceback
+from contextlib import redirect_stdout
+import slack
+from slack import PROGRESS_INTERVAL, atomic_write, format_duration, log
+
+def main():
+    workspaces, args = parse_args()
+    results = export_workspaces(workspaces, processes=args.processes, max_bandwidth=args.max_bandwidth)
+    print_summary(results)
+    if args.summary_json:
+        with atomic_write(args.summary_json) as f:
+            json.dump(results, f, indent=4)
+    if any(result["error"] for result in results.values()):
+        sys.exit(1)
+
+
+def parse_args():
+    """Parses the CLI arguments to produce the workspaces to export, each with
+    its config, output directory and slack.py options, and the batch
+    options. Arguments after a -- are passed on to slack.py for every
+    workspace."""
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("output_path", type=str, help="Directory to export into, with a subdirectory for each workspace named after its config file")
+    parser.add_argument("configs", type=str, nargs="+", help="Config files of the workspaces to export")
+    parser.add_argument("--processes", type=int, default=None, help="Number of workspaces to export at once, each in its own process (default: all of them)")
+    parser.add_argument("--max-bandwidth", type=float, default=None, help="Cap file downloads across every workspace at this many megabytes a second")
+    parser.add_argument("--summary-json", type=str, default=None, help="Write the summary of every workspace, with its stats, to this file")
+    argv = sys.argv[1:]
+    split = argv.index("--") if "--" in argv else len(argv)
+    args = parser.parse_args(argv[:split])
+    args.slack_args = argv[split + 1:]
+    output_path = args.output_path.rstrip("/")
+    workspaces = {}
+    for config in args.configs:
+        name = os.path.splitext(os.path.basename(config))[0]
+        if name in workspaces:
+            parser.error(f"more than one config is named {name}")
+        workspaces[name] = slack.parse_args([config, f"{output_path}/{name}", *args.slack_args])
+    return workspaces, args
+
+
+def export_workspaces(workspaces, processes=None, max_bandwidth=None):
+    """Exports several workspaces at once, each in a fresh process of its own,
+    with downloads across all of them sharing one bandwidth cap. Returns a
+    summary of each, recording a workspace failing rather than stopping the
+    others."""
+
+    context = multiprocessing.get_context("spawn")
+    reports = context.Queue()
+    limiter = slack.BandwidthLimiter.shared(max_bandwidth * 1000 * 1000 if max_bandwidth else None, context)
+    waiting = list(workspaces)
+    running = {}
+    results = {}
+    progress = {name: None for name in workspaces}
+    last_progress = time.monotonic()
+    log(f"Exporting {len(workspaces)} workspaces")
+    while waiting or running:
+        while waiting and len(running) < (processes or len(workspaces)):
+            name = waiting.pop(0)
+            data, output_path, args = workspaces[name]
+            running[name] = context.Process(
+                target=export_in_worker, args=(name, data, output_path, args, limiter, reports), name=f"export-{name}",
+            )
+            running[name].start()
+        try:
+            receive_report(reports.get(timeout=1), progress, results)
+        except queue.Empty:
+            pass
+        finished = [name for name, process in running.items() if not process.is_alive()]
+        for name in finished:
+            while True:
+                try:
+                    receive_report(reports.get_nowait(), progress, results)
+                except queue.Empty:
+                    break
+            process = running.pop(name)
+            process.join()
+            if name not in results:
+                results[name] = {"output_path": workspaces[name][1], "error": f"worker exited with code {process.exitcode}", "stats": progress[name]}
+            progress[name] = results[name]["stats"]
+            if results[name]["error"]:
+                log(f"{name} failed: {results[name]['error']}", indent=1)
+            else:
+                log(f"{name} finished", indent=1)
+        if finished or time.monotonic() - last_progress >= PROGRESS_INTERVAL:
+            last_progress = time.monotonic()
+            log_progress(progress, len(results))
+    return {name: results[name] for name in workspaces}
+
+
+def receive_report(report, progress, results):
+    """Records a report from a worker process: either its stats so far, or
+    the summary it returns once it has finished."""
+
+    kind, name, content = report
+    if kind == "result":
+        results[name] = content
+    else:
+        progress[name] = content
+
+
+def export_in_worker(name, data, output_path, args, limiter, reports):
+    """Exports a workspace in a worker process, logging to export.log in its
+    output directory, and reporting its stats back every PROGRESS_INTERVAL
+    seconds. Puts a summary of the export on the queue when it finishes,
+    with the error if it failed."""
+
+    slack.bandwidth = limiter
+    os.makedirs(output_path, exist_ok=True)
+    error = None
+    finished = threading.Event()
+    reporter = threading.Thread(target=report_progress, args=(name, reports, finished), daemon=True)
+    with open(f"{output_path}/export.log", "a", buffering=1) as f, redirect_stdout(f):
+        reporter.start()
+        try:
+            slack.export_workspace(data, output_path, args)
+        except Exception as e:
+            traceback.print_exc(file=f)
+            error = f"{type(e).__name__}: {e}"
+        finally:
+            finished.set()
+            reporter.join()
+    reports.put(("result", name, {"output_path": output_path, "error": error, "stats": slack.stats.report()}))
+
+
+def report_progress(name, reports, finished):
+    """Puts the stats of the export on the queue every PROGRESS_INTERVAL
+    seconds until it has finished."""
+
+    while not finished.wait(PROGRESS_INTERVAL):
+        reports.put(("progress", name, slack.stats.report()))
+
+
+def downloaded_bytes(report):
+    """Returns how many bytes of files a run's stats say were downloaded."""
+
+    return sum(entry["bytes"] for method, entry in report["methods"].items() if method.startswith("GET "))
+
+
+def log_progress(progress, finished):
+    """Logs the combined progress of every workspace."""
+
+    reports = [report for report in progress.values() if report]
+    channels = sum(report["channels"]["done"] for report in reports)
+    channels_total = sum(report["channels"]["total"] for report in reports)
+    messages = sum(report["messages"] for report in reports)
+    downloaded = sum(downloaded_bytes(report) for report in reports)
+    log(f"Progress: {finished}/{len(progress)} workspaces, {channels}/{channels_total} channels, {messages} messages, {downloaded / 1e6:.1f} MB of files")
+
+
+def print_summary(results):
+    """Prints a line for each workspace with what it fetched, and the error if
+    it failed."""
+
+    print(f"{'Workspace':<24} {'Status':<8} {'Channels':>11} {'Messages':>10} {'Requests':>9} {'Files MB':>9} {'Time':>8}")
+    for name, result in results.items():
+        report = result["stats"] or {"channels": {"done": 0, "total": 0}, "messages": 0, "methods": {}, "wall_seconds": 0}
+        requests = sum(entry["count"] for entry in report["methods"].values())
+        channels = f"{report['channels']['done']}/{report['channels']['total']}"
+        status = "failed" if result["error"] else "ok"
+        print(
+            f"{name:<24} {status:<8} {channels:>11} {report['messages']:>10} {requests:>9} "
+            f"{downloaded_bytes(report) / 1e6:>9.1f} {format_duration(report['wall_seconds']):>8}"
+        )
+        if result["error"]:
+            print(f"    {result['error']}")
+
+
+if __name__ == "__main__":
+    main()
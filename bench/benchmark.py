@@ -0,0 +1,129 @@
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from mock_slack import add_options, start_server
+
+SLACK_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "slack.py")
+
+def main():
+    args = parse_args()
+    server = start_server(args)
+    report = run_benchmark(server, args.output, args.slack_args)
+    server.shutdown()
+    print_report(report)
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=4)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_reports(report, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+def parse_args():
+    """Parses the CLI arguments, which describe the synthetic workspace, where
+    to write the report, and any arguments to pass on to slack.py after a
+    --."""
+
+    parser = argparse.ArgumentParser()
+    add_options(parser)
+    parser.add_argument("--output", type=str, default=None, help="Archive directory to export into (default: a temporary directory, removed afterwards)")
+    parser.add_argument("--report", type=str, default=None, help="Write the report to this JSON file")
+    parser.add_argument("--baseline", type=str, default=None, help="Compare against a previous report, exiting with an error on a regression")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Fraction a baseline figure can get worse by before it counts as a regression")
+    parser.add_argument("slack_args", nargs=argparse.REMAINDER, help="Arguments for slack.py, after a --")
+    args = parser.parse_args()
+    if args.slack_args[:1] == ["--"]:
+        args.slack_args = args.slack_args[1:]
+    return args
+
+
+def run_benchmark(server, output_path=None, slack_args=()):
+    """Runs slack.py against the mock server in a subprocess, and returns a
+    report of how long it took, how much it fetched, and its peak memory."""
+
+    temp = tempfile.mkdtemp(prefix="slack-bench-")
+    output_path = output_path or os.path.join(temp, "output")
+    config_path = os.path.join(temp, "config.json")
+    with open(config_path, "w") as f:
+        json.dump({
+            "workspace": "bench",
+            "token": "xoxc-bench",
+            "cookie": "d=xoxd-bench",
+            "api_url": f"{server.base_url}/api",
+        }, f)
+    command = [sys.executable, SLACK_PATH, config_path, output_path, *slack_args]
+    start = time.perf_counter()
+    result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    wall = time.perf_counter() - start
+    if result.returncode:
+        sys.exit(f"slack.py failed:\n{result.stderr}")
+    messages = count_messages(output_path)
+    stats = server.slack.stats()
+    requests = sum(stats["requests"].values())
+    report = {
+        "args": slack_args,
+        "wall_seconds": round(wall, 3),
+        "messages": messages,
+        "messages_per_second": round(messages / wall, 1),
+        "requests": requests,
+        "requests_per_second": round(requests / wall, 1),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+        "bytes_served": stats["bytes_sent"],
+        "requests_by_method": stats["requests"],
+        "ratelimited_by_method": stats["ratelimited"],
+    }
+    shutil.rmtree(temp)
+    return report
+
+
+def count_messages(output_path):
+    """Counts the messages and replies in an exported archive."""
+
+    count = 0
+    channels_path = os.path.join(output_path, "channels")
+    for filename in os.listdir(channels_path) if os.path.isdir(channels_path) else []:
+        with open(os.path.join(channels_path, filename)) as f:
+            for line in f:
+                count += 1 + len(json.loads(line).get("replies", []))
+    return count
+
+
+def print_report(report):
+    """Prints the headline figures of a report."""
+
+    print(f"Wall time:     {report['wall_seconds']:.2f}s")
+    print(f"Messages:      {report['messages']} ({report['messages_per_second']:.1f}/s)")
+    print(f"Requests:      {report['requests']} ({report['requests_per_second']:.1f}/s)")
+    print(f"Peak RSS:      {report['peak_rss_mb']:.1f} MB")
+    for method, count in sorted(report["requests_by_method"].items()):
+        limited = report["ratelimited_by_method"].get(method, 0)
+        print(f"    {method:<28} {count:>7}{f' ({limited} ratelimited)' if limited else ''}")
+
+
+def compare_reports(report, baseline, tolerance):
+    """Returns a description of each way a report is worse than a baseline by
+    more than the tolerance."""
+
+    regressions = []
+    if report["messages_per_second"] < baseline["messages_per_second"] * (1 - tolerance):
+        regressions.append(f"messages/s fell from {baseline['messages_per_second']} to {report['messages_per_second']}")
+    if report["requests_per_second"] < baseline["requests_per_second"] * (1 - tolerance):
+        regressions.append(f"requests/s fell from {baseline['requests_per_second']} to {report['requests_per_second']}")
+    if report["peak_rss_mb"] > baseline["peak_rss_mb"] * (1 + tolerance):
+        regressions.append(f"peak RSS rose from {baseline['peak_rss_mb']} MB to {report['peak_rss_mb']} MB")
+    return regressions
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,420 @@
+import argparse
+import bisect
+import gzip
+import json
+import random
+import threading
+import time
+import urllib.parse
+import zlib
+from collections import Counter
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+START = 1500000000
+STEP = 60
+
+def main():
+    options = parse_args()
+    server = start_server(options)
+    print(f"Mock Slack listening on {server.base_url}/api")
+    try:
+        server.serve_thread.join()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+def parse_args():
+    """Parses the CLI arguments describing the synthetic workspace to serve."""
+
+    parser = argparse.ArgumentParser()
+    add_options(parser)
+    return parser.parse_args()
+
+
+def add_options(parser):
+    """Adds the options describing a synthetic workspace to an argument parser,
+    so that the benchmark can accept the same ones."""
+
+    parser.add_argument("--port", type=int, default=0, help="Port to listen on (default: any free port)")
+    parser.add_argument("--channels", type=int, default=20, help="Number of conversations, cycling through public, private, DM and group DM")
+    parser.add_argument("--messages", type=int, default=2000, help="Messages per conversation")
+    parser.add_argument("--thread-every", type=int, default=10, help="Every Nth message starts a thread (0 for none)")
+    parser.add_argument("--replies", type=int, default=5, help="Replies per thread")
+    parser.add_argument("--file-every", type=int, default=50, help="Every Nth message has a file attached (0 for none)")
+    parser.add_argument("--file-size", type=int, default=100_000, help="Size of each attached file in bytes")
+    parser.add_argument("--reaction-every", type=int, default=20, help="Every Nth message has a custom emoji reaction (0 for none)")
+    parser.add_argument("--emoji", type=int, default=10, help="Number of distinct custom emoji")
+    parser.add_argument("--image-changes", type=float, default=0.0, help="Fraction of custom emoji and profile photos whose image has changed since the start of the workspace, to test refreshing them")
+    parser.add_argument("--users", type=int, default=200, help="Number of users in the directory")
+    parser.add_argument("--external-users", type=int, default=5, help="Number of users only findable with users.info")
+    parser.add_argument("--bots", type=int, default=5, help="Number of bots, which send every 97th message")
+    parser.add_argument("--latency", type=float, default=20, help="Milliseconds added to every response")
+    parser.add_argument("--jitter", type=float, default=10, help="Maximum random milliseconds added on top of the latency")
+    parser.add_argument("--ratelimit", type=float, default=0.0, help="Probability of answering an API call with ratelimited")
+    parser.add_argument("--retry-after", type=float, default=1, help="Retry-After seconds sent with ratelimited responses")
+    parser.add_argument("--enterprise", action="store_true", help="Refuse users.conversations and users.list, as enterprise workspaces do")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for latency and ratelimiting")
+
+
+class MockSlack:
+    """A synthetic Slack workspace. Everything is generated from the message
+    index, so even very large workspaces take no memory to serve, and every
+    run against the same options sees exactly the same data."""
+
+    def __init__(self, options, base_url):
+        self.options = options
+        self.base_url = base_url
+        self.random = random.Random(options.seed)
+        self.lock = threading.Lock()
+        self.requests = Counter()
+        self.ratelimited = Counter()
+        self.bytes_sent = 0
+
+    def channel(self, index):
+        """Returns the channel object for a channel index."""
+
+        kind = index % 4
+        if kind == 2:
+            return {"id": f"D{index:08d}", "is_im": True, "user": self.user_id(index)}
+        channel = {"id": f"{'CCDG'[kind]}{index:08d}", "name": f"channel-{index}", "created": START}
+        if kind == 1:
+            channel["is_private"] = True
+        if kind == 3:
+            channel["is_mpim"] = True
+            channel["members"] = [self.user_id(index + n) for n in range(3)]
+        return channel
+
+    def channel_index(self, channel_id):
+        """Returns the index of a channel from its ID."""
+
+        return int(channel_id[1:])
+
+    def user_id(self, index):
+        """Returns the ID of the user who sends message index, where a few of
+        them are external users missing from the directory."""
+
+        if self.options.external_users and index % 41 == 0:
+            return f"W{index % self.options.external_users:08d}"
+        return f"U{index % self.options.users:08d}"
+
+    def user(self, user_id):
+        """Returns the user object for a user ID."""
+
+        return {
+            "id": user_id,
+            "name": f"user-{user_id.lower()}",
+            "profile": {"image_72": f"{self.base_url}/avatars/{user_id}.png"},
+        }
+
+    def bot(self, bot_id):
+        """Returns the bot object for a bot ID."""
+
+        return {
+            "id": bot_id,
+            "name": f"bot-{bot_id.lower()}",
+            "icons": {"image_72": f"{self.base_url}/avatars/{bot_id}.png"},
+        }
+
+    def ts(self, index, reply=0):
+        """Returns the timestamp of a message, or of one of its replies."""
+
+        return f"{START + index * STEP}.{reply:06d}"
+
+    def message(self, channel_index, index):
+        """Returns message index of a channel."""
+
+        options = self.options
+        message = {"type": "message", "ts": self.ts(index), "text": f"Message {index} in channel {channel_index}"}
+        if options.bots and index % 97 == 0:
+            message["bot_id"] = f"B{index % options.bots:08d}"
+        else:
+            message["user"] = self.user_id(index + channel_index)
+        if options.thread_every and index % options.thread_every == 0 and options.replies:
+            message["thread_ts"] = message["ts"]
+            message["reply_count"] = options.replies
+            message["latest_reply"] = self.ts(index, options.replies)
+        if options.file_every and index % options.file_every == 0:
+            file_id = f"F{channel_index:04d}{index:08d}"
+            message["files"] = [{
+                "id": file_id,
+                "filetype": "bin",
+                "size": options.file_size,
+                "url_private_download": f"{self.base_url}/files/{file_id}/download.bin",
+            }]
+        if options.reaction_every and index % options.reaction_every == 0 and options.emoji:
+            name = f"emoji-{index // options.reaction_every % options.emoji}"
+            message["reactions"] = [{
+                "name": name,
+                "url": f"{self.base_url}/emoji/{name}.png",
+                "users": [self.user_id(index + 1)],
+                "count": 1,
+            }]
+        return message
+
+    def reply(self, channel_index, index, reply):
+        """Returns one of the replies to message index of a channel."""
+
+        return {
+            "type": "message",
+            "ts": self.ts(index, reply),
+            "thread_ts": self.ts(index),
+            "text": f"Reply {reply} to message {index}",
+            "user": self.user_id(index + reply),
+        }
+
+    def handle_api(self, method, params):
+        """Answers a call to an API method, returning the response object."""
+
+        handler = getattr(self, "api_" + method.replace(".", "_"), None)
+        if handler is None:
+            return {"ok": False, "error": "unknown_method"}
+        return handler(params)
+
+    def api_users_conversations(self, params):
+        """Returns a page of the conversations of the requested types."""
+
+        if self.options.enterprise:
+            return {"ok": False, "error": "enterprise_is_restricted"}
+        channels = [self.channel(index) for index in range(self.options.channels)]
+        types = set(params.get("types", "public_channel,private_channel,im,mpim").split(","))
+        channels = [channel for channel in channels if channel_type(channel) in types]
+        return paged(channels, params, "channels", default_limit=100)
+
+    def api_client_userBoot(self, params):
+        """Returns every conversation at once, as enterprise workspaces do."""
+
+        channels = [self.channel(index) for index in range(self.options.channels)]
+        return {
+            "ok": True,
+            "channels": [channel for channel in channels if not channel.get("is_im")],
+            "ims": [channel for channel in channels if channel.get("is_im")],
+        }
+
+    def api_users_list(self, params):
+        """Returns a page of the user directory."""
+
+        if self.options.enterprise:
+            return {"ok": False, "error": "enterprise_is_restricted"}
+        users = [self.user(f"U{index:08d}") for index in range(self.options.users)]
+        return paged(users, params, "members", default_limit=100)
+
+    def api_users_info(self, params):
+        """Returns a single user, including external ones."""
+
+        user_id = params.get("user", "")
+        if user_id == "USLACKBOT" or user_id[:1] in "UW" and user_id[1:].isdigit():
+            return {"ok": True, "user": self.user(user_id)}
+        return {"ok": False, "error": "user_not_found"}
+
+    def api_bots_info(self, params):
+        """Returns a single bot."""
+
+        bot_id = params.get("bot", "")
+        if bot_id[:1] == "B" and bot_id[1:].isdigit():
+            return {"ok": True, "bot": self.bot(bot_id)}
+        return {"ok": False, "error": "bot_not_found"}
+
+    def api_conversations_view(self, params):
+        """Returns the overview of a conversation, with its members."""
+
+        index = self.channel_index(params["channel"])
+        return {"ok": True, "users": [self.user(self.user_id(index + n)) for n in range(3)]}
+
+    def api_conversations_history(self, params):
+        """Returns a page of messages, newest first, between the latest and
+        oldest bounds, continuing from the cursor if there is one."""
+
+        channel_index = self.channel_index(params["channel"])
+        count = self.options.messages
+        inclusive = params.get("inclusive") in ("1", "true")
+        key = lambda index: float(self.ts(index))
+        oldest = float(params.get("oldest") or 0)
+        latest = float(params["latest"]) if params.get("latest") else float("inf")
+        low = (bisect.bisect_left if inclusive else bisect.bisect_right)(range(count), oldest, key=key)
+        high = (bisect.bisect_right if inclusive else bisect.bisect_left)(range(count), latest, key=key) - 1
+        if params.get("cursor"):
+            high = min(high, int(params["cursor"]))
+        limit = min(int(params.get("limit") or 100), 999)
+        stop = max(low, high - limit + 1)
+        messages = [self.message(channel_index, index) for index in range(high, stop - 1, -1)]
+        response = {"ok": True, "messages": messages, "has_more": stop > low}
+        response["response_metadata"] = {"next_cursor": str(stop - 1) if stop > low else ""}
+        return response
+
+    def api_conversations_replies(self, params):
+        """Returns a page of a thread, oldest first, with the parent message at
+        the start of every page as Slack does."""
+
+        channel_index = self.channel_index(params["channel"])
+        index = (int(float(params["ts"])) - START) // STEP
+        parent = self.message(channel_index, index)
+        oldest = float(params.get("oldest") or 0)
+        replies = [
+            self.reply(channel_index, index, reply)
+            for reply in range(1, parent.get("reply_count", 0) + 1)
+            if float(self.ts(index, reply)) > oldest
+        ]
+        response = paged(replies, params, "messages", default_limit=1000)
+        response["messages"].insert(0, parent)
+        return response
+
+    def file_size(self, path):
+        """Returns the size of the file served at a path, or None if there is
+        no such file."""
+
+        if path.startswith("/files/"):
+            return self.options.file_size
+        if path.startswith(("/emoji/", "/avatars/")):
+            return 2048
+        return None
+
+    def file_version(self, path):
+        """Returns the version of the file served at a path: 1 for the chosen
+        fraction of emoji and profile photos that have changed, and 0
+        otherwise."""
+
+        if not path.startswith(("/emoji/", "/avatars/")):
+            return 0
+        return int(zlib.crc32(path.encode()) % 1000 < self.options.image_changes * 1000)
+
+    def record(self, method, ratelimited=False, sent=0):
+        """Counts a request for the run's statistics."""
+
+        with self.lock:
+            self.requests[method] += 1
+            if ratelimited:
+                self.ratelimited[method] += 1
+            self.bytes_sent += sent
+
+    def delay(self):
+        """Sleeps for the configured latency, and decides whether the request
+        should be ratelimited."""
+
+        with self.lock:
+            jitter = self.random.uniform(0, self.options.jitter)
+            ratelimited = self.random.random() < self.options.ratelimit
+        time.sleep((self.options.latency + jitter) / 1000)
+        return ratelimited
+
+    def stats(self):
+        """Returns the counts of requests served so far."""
+
+        with self.lock:
+            return {
+                "requests": dict(self.requests),
+                "ratelimited": dict(self.ratelimited),
+                "bytes_sent": self.bytes_sent,
+            }
+
+
+def channel_type(channel):
+    """Returns the users.conversations type of a channel object."""
+
+    if channel.get("is_im"):
+        return "im"
+    if channel.get("is_mpim"):
+        return "mpim"
+    return "private_channel" if channel.get("is_private") else "public_channel"
+
+
+def paged(items, params, key, default_limit):
+    """Returns one cursor-paged slice of a list as an API response."""
+
+    offset = int(params.get("cursor") or 0)
+    limit = int(params.get("limit") or default_limit)
+    page = items[offset:offset + limit]
+    next_cursor = str(offset + limit) if offset + limit < len(items) else ""
+    return {"ok": True, key: page, "response_metadata": {"next_cursor": next_cursor}}
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Serves API calls under /api/ and files everywhere else, over keep-alive
+    connections, gzipping API responses when the client accepts it. Files
+    have ETag and Last-Modified validators, and conditional requests for
+    unchanged files are answered with 304 Not Modified."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length).decode()
+        self.handle_request(dict(urllib.parse.parse_qsl(body)))
+
+    def do_GET(self):
+        self.handle_request({})
+
+    def handle_request(self, form):
+        slack = self.server.slack
+        url = urllib.parse.urlsplit(self.path)
+        ratelimited = slack.delay()
+        if url.path.startswith("/api/"):
+            method = url.path[5:]
+            params = {**form, **dict(urllib.parse.parse_qsl(url.query))}
+            if ratelimited:
+                response, status = {"ok": False, "error": "ratelimited"}, 429
+            else:
+                response, status = slack.handle_api(method, params), 200
+            body = json.dumps(response).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            if ratelimited:
+                self.send_header("Retry-After", f"{slack.options.retry_after:g}")
+            if "gzip" in (self.headers.get("Accept-Encoding") or ""):
+                body = gzip.compress(body, compresslevel=1)
+                self.send_header("Content-Encoding", "gzip")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            slack.record(method, ratelimited, len(body))
+            return
+        size = slack.file_size(url.path)
+        if size is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            slack.record("GET 404")
+            return
+        version = slack.file_version(url.path)
+        etag = f'"{version}-{zlib.crc32(url.path.encode()):08x}"'
+        modified = formatdate(START + version * 86400, usegmt=True)
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match == etag or (not if_none_match and self.headers.get("If-Modified-Since") == modified):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            slack.record("GET 304")
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(size))
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", modified)
+        self.end_headers()
+        chunk = bytes((byte + version) % 256 for byte in range(256)) * 256
+        remaining = size
+        while remaining:
+            self.wfile.write(chunk[:remaining])
+            remaining -= min(remaining, len(chunk))
+        slack.record("GET " + url.path.split("/")[1], sent=size)
+
+
+def start_server(options, host="127.0.0.1"):
+    """Starts serving a synthetic workspace in a background thread, returning
+    the server. Its base_url, slack and serve_thread attributes give where it
+    is listening, the MockSlack it serves, and the thread serving it."""
+
+    server = ThreadingHTTPServer((host, options.port), Handler)
+    server.daemon_threads = True
+    server.base_url = f"http://{host}:{server.server_port}"
+    server.slack = MockSlack(options, server.base_url)
+    server.serve_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server.serve_thread.start()
+    return server
+
+
+if __name__ == "__main__":
+    main()
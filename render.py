@@ -0,0 +1,290 @@
+import argparse
+import hashlib
+import html
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import ExitStack
+from datetime import datetime
+from slack import atomic_write, iter_messages, log, read_manifest_log
+
+FORMATS = ("txt", "md", "html")
+RENDER_VERSION = 1
+MAX_CACHED_MINUTES = 10000
+HTML_HEAD = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<style>
+body {{ font-family: -apple-system, "Segoe UI", Helvetica, Arial, sans-serif; max-width: 960px; margin: 2em auto; color: #1d1c1d; }}
+.message {{ display: flex; gap: 0.6em; margin: 0.8em 0; }}
+.avatar {{ width: 36px; height: 36px; border-radius: 4px; flex: none; background: #ddd; }}
+.sender {{ font-weight: bold; }}
+.time {{ color: #616061; font-size: 0.85em; margin-left: 0.4em; }}
+.text {{ white-space: pre-wrap; }}
+.thread {{ margin-left: 1.2em; padding-left: 0.8em; border-left: 3px solid #ddd; }}
+.thread .avatar {{ width: 24px; height: 24px; }}
+.files a {{ display: block; font-size: 0.9em; }}
+</style>
+</head>
+<body>
+<h1>{title}</h1>
+"""
+
+renderer = None
+
+
+def main():
+    output_path, args = parse_args()
+    render_archive(output_path, formats=args.format, workers=args.workers, force=args.force, target=args.target)
+
+
+def parse_args():
+    """Parses the CLI arguments to produce the path of the archive to render,
+    and the rendering options."""
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("output_path", type=str, help="An output directory written by slack.py")
+    parser.add_argument("--format", type=str, nargs="+", choices=FORMATS, default=list(FORMATS), help="Formats to render (default: all)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of conversations to render at once, each in its own process")
+    parser.add_argument("--target", type=str, default=None, help="Directory to write transcripts to (default: the archive itself)")
+    parser.add_argument("--force", action="store_true", help="Render every conversation, even those that haven't changed")
+    args = parser.parse_args()
+    return args.output_path.rstrip("/"), args
+
+
+def render_archive(output_path, formats=FORMATS, workers=1, force=False, target=None):
+    """Renders a transcript of every downloaded conversation in an archive in
+    each of the formats, in a pool of processes. Each conversation's content
+    hash is remembered, and conversations are only rendered again once it,
+    or the names and photos of the people in the archive, have changed."""
+
+    target = target or output_path
+    with open(f"{output_path}/index.json") as f:
+        index = json.load(f)
+    directory = sender_directory(output_path, index, target)
+    state_path = f"{target}/render_state.json"
+    state = {}
+    if os.path.exists(state_path) and not force:
+        with open(state_path) as f:
+            state = json.load(f)
+    if state.get("key") != directory["key"]:
+        state = {"key": directory["key"], "channels": {}}
+    pending = []
+    for channel_id, channel in index["channels"].items():
+        if "message_count" not in channel:
+            continue
+        previous = state["channels"].get(channel_id, {})
+        content = content_hash(f"{output_path}/channels/{channel_id}.jsonl", previous)
+        name = channel.get("readable_name") or channel.get("name") or channel_id
+        unchanged = content["hash"] == previous.get("hash") and name == previous.get("name")
+        if unchanged and set(formats) <= set(previous["formats"]):
+            continue
+        rendered = sorted(set(formats) | set(previous["formats"] if unchanged else []))
+        pending.append((channel_id, name, content, rendered))
+    log(f"Rendering {len(pending)} of {sum('message_count' in channel for channel in index['channels'].values())} conversations")
+    os.makedirs(target, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=max(workers, 1), initializer=start_worker, initargs=(directory,)) as executor:
+        futures = {
+            executor.submit(render_channel, output_path, channel_id, name, formats, target): (channel_id, name, content, rendered)
+            for channel_id, name, content, rendered in pending
+        }
+        for future in as_completed(futures):
+            channel_id, name, content, rendered = futures[future]
+            future.result()
+            log(f"Rendered {name}", indent=1)
+            state["channels"][channel_id] = {**content, "name": name, "formats": rendered}
+    with atomic_write(state_path) as f:
+        json.dump(state, f)
+
+
+def content_hash(path, previous):
+    """Returns the SHA-256 of a channel's file, along with its size and
+    modification time. If those are the same as when it was last hashed, the
+    previous hash is reused rather than reading the file again."""
+
+    stat = os.stat(path)
+    if previous.get("size") == stat.st_size and previous.get("mtime") == stat.st_mtime_ns:
+        return {"size": stat.st_size, "mtime": stat.st_mtime_ns, "hash": previous["hash"]}
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            digest.update(chunk)
+    return {"size": stat.st_size, "mtime": stat.st_mtime_ns, "hash": digest.hexdigest()}
+
+
+def sender_directory(output_path, index, target):
+    """Resolves everything a transcript needs to know about people, bots and
+    files up front: each sender's display name, the path of their photo, and
+    the path of each downloaded file, relative to where transcripts are
+    written. The key is a hash of the names and photos, so that transcripts
+    are rendered again when any of them change. Files aren't part of it, as
+    new files only ever arrive with new messages."""
+
+    manifest_path = f"{output_path}/slack_files/manifest.json"
+    manifest = {"files": {}, "people": {}}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest.update(json.load(f))
+    for kind, key, entry in read_manifest_log(f"{output_path}/slack_files"):
+        manifest.setdefault(kind, {})[key] = entry
+    blobs = os.path.relpath(f"{output_path}/slack_files/blobs", target)
+    blob_path = lambda entry: f"{blobs}/{entry['blob'][:2]}/{entry['blob']}"
+    directory = {
+        "people": {id: person.get("name", id) for id, person in index["people"].items()},
+        "bots": {id: bot.get("name", id) for id, bot in index["bots"].items()},
+        "avatars": {id: blob_path(entry) for id, entry in manifest["people"].items()},
+    }
+    directory["key"] = hashlib.sha256(json.dumps([RENDER_VERSION, directory], sort_keys=True).encode()).hexdigest()
+    directory["files"] = {id: blob_path(entry) for id, entry in manifest["files"].items()}
+    return directory
+
+
+def start_worker(directory):
+    """Sets up a worker process with the renderer it will use for every
+    conversation it renders."""
+
+    global renderer
+    renderer = Renderer(directory)
+
+
+def render_channel(output_path, channel_id, name, formats, target):
+    """Renders one conversation in each of the formats, in a worker process.
+    The messages are read once, and written to every format as they are
+    read."""
+
+    filename = name.replace(" ", "_").replace(",", "_")
+    writers = {"txt": renderer.txt_lines, "md": renderer.md_lines, "html": renderer.html_lines}
+    with ExitStack() as stack:
+        files = {format: stack.enter_context(atomic_write(f"{target}/{filename}.{format}")) for format in formats}
+        renderer.begin(files, name)
+        for message in iter_messages(output_path, channel_id):
+            for format in formats:
+                writers[format](files[format], message)
+        renderer.end(files)
+
+
+class Renderer:
+    """Writes messages out as text, Markdown and HTML. Sender names and photos
+    are resolved from a directory made once for the whole archive, and
+    formatted times are cached by the minute, for one conversation at a time,
+    so rendering a message costs a couple of dictionary lookups on top of
+    writing it out."""
+
+    def __init__(self, directory):
+        self.people = directory["people"]
+        self.bots = directory["bots"]
+        self.avatars = directory["avatars"]
+        self.files = directory["files"]
+        self.minutes = {}
+        self.started = {}
+
+    def time(self, ts):
+        """Formats a timestamp as YYYY-MM-DD HH:MM:SS in local time, working
+        out the date, hour and minute once per minute. At most
+        MAX_CACHED_MINUTES are cached before starting again."""
+
+        seconds = int(float(ts))
+        minute = self.minutes.get(seconds // 60)
+        if minute is None:
+            if len(self.minutes) >= MAX_CACHED_MINUTES:
+                self.minutes.clear()
+            minute = self.minutes[seconds // 60] = datetime.fromtimestamp(seconds - seconds % 60).strftime("%Y-%m-%d %H:%M")
+        return f"{minute}:{seconds % 60:02d}"
+
+    def sender(self, message):
+        """Returns the display name for whoever sent a message, checking people
+        first then bots, and the ID used for their photo."""
+
+        if user := message.get("user"):
+            return self.people.get(user, user), user
+        if bot_id := message.get("bot_id"):
+            return self.bots.get(bot_id, bot_id), bot_id
+        return "", None
+
+    def begin(self, files, name):
+        """Writes the start of each file, and forgets the times cached for the
+        last conversation."""
+
+        self.minutes = {}
+        self.started = {format: False for format in files}
+        if "md" in files:
+            files["md"].write(f"# {name}\n")
+        if "html" in files:
+            files["html"].write(HTML_HEAD.format(title=html.escape(name)))
+
+    def end(self, files):
+        """Writes the end of each file."""
+
+        if "html" in files:
+            files["html"].write("</body>\n</html>\n")
+
+    def txt_lines(self, f, message):
+        """Writes a message and its replies as plain text, in the same format
+        as slack.py's text files."""
+
+        if self.started["txt"]:
+            f.write("\n")
+        self.started["txt"] = True
+        f.write(f"{self.time(message['ts'])}: [{self.sender(message)[0]}] {message['text']}\n")
+        for reply in message.get("replies", []):
+            f.write(f"\n    [{self.sender(reply)[0]}] {reply['text']}")
+        f.write("\n")
+
+    def md_lines(self, f, message):
+        """Writes a message as Markdown, with its replies quoted underneath."""
+
+        f.write(f"\n**{self.sender(message)[0]}** {self.time(message['ts'])}\n\n{message['text']}\n")
+        f.write(self.md_files(message, ""))
+        for reply in message.get("replies", []):
+            text = reply["text"].replace("\n", "\n> ")
+            f.write(f"\n> **{self.sender(reply)[0]}** {self.time(reply['ts'])}\n>\n> {text}\n")
+            f.write(self.md_files(reply, "> "))
+
+    def md_files(self, message, prefix):
+        """Returns Markdown links to a message's files."""
+
+        return "".join(
+            f"{prefix}\n{prefix}[{file.get('name') or file['id']}]({link})\n"
+            for file in message.get("files", []) if (link := self.file_link(file))
+        )
+
+    def html_lines(self, f, message):
+        """Writes a message as HTML, with its replies nested underneath."""
+
+        f.write(self.html_message(message))
+        if replies := message.get("replies"):
+            f.write('<div class="thread">\n')
+            for reply in replies:
+                f.write(self.html_message(reply))
+            f.write("</div>\n")
+
+    def html_message(self, message):
+        """Returns a single message as HTML, with its sender's photo and links
+        to its files."""
+
+        name, sender_id = self.sender(message)
+        avatar = self.avatars.get(sender_id)
+        image = f'<img class="avatar" src="{html.escape(avatar)}" alt="">' if avatar else '<div class="avatar"></div>'
+        links = "".join(
+            f'<a href="{html.escape(link)}" download="{html.escape(file_name)}">{html.escape(file_name)}</a>'
+            for file in message.get("files", []) if (link := self.file_link(file))
+            for file_name in [file.get("name") or file["id"]]
+        )
+        files = f'<div class="files">{links}</div>' if links else ""
+        return (
+            f'<div class="message" id="{message["ts"]}">{image}<div>'
+            f'<span class="sender">{html.escape(name)}</span><span class="time">{self.time(message["ts"])}</span>'
+            f'<div class="text">{html.escape(message["text"])}</div>{files}</div></div>\n'
+        )
+
+    def file_link(self, file):
+        """Returns where to link to for a file: the downloaded copy if there is
+        one, or otherwise its page on Slack."""
+
+        return self.files.get(file.get("id")) or file.get("permalink")
+
+
+if __name__ == "__main__":
+    main()
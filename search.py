@@ -0,0 +1,100 @@
+import argparse
+import os
+import sqlite3
+import sys
+import time
+from slack import format_timestamp, parse_date
+
+
+def main():
+    db, args, parser = parse_args()
+    text = args.query if args.fts or not args.query else quote_terms(args.query)
+    started = time.perf_counter()
+    try:
+        results = search(db, text=text, user=args.user, channel=args.channel, since=args.since, until=args.until, limit=args.limit)
+    except sqlite3.OperationalError as e:
+        parser.error(f"invalid query {args.query!r}: {e}")
+    elapsed = time.perf_counter() - started
+    for result in results:
+        print(format_result(result))
+    print(f"{len(results)} result{'' if len(results) == 1 else 's'} in {elapsed * 1000:.1f} ms", file=sys.stderr)
+
+
+def parse_args():
+    """Parses the CLI arguments to produce a read-only connection to the
+    archive's database, the search options, and the parser itself for
+    reporting errors."""
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("data_path", type=str, help="An output directory written by slack.py --sqlite, or its archive.db")
+    parser.add_argument("query", type=str, nargs="?", default=None, help="Words which must all appear in a message, in any order")
+    parser.add_argument("--fts", action="store_true", help="Pass the query to SQLite as raw FTS5 syntax (e.g. 'deploy OR friday', '\"exact phrase\"', 'migrat*') instead of as plain words")
+    parser.add_argument("--user", type=str, default=None, help="Only messages sent by this user or bot, by ID or name")
+    parser.add_argument("--channel", type=str, default=None, help="Only messages in this conversation, by ID or name")
+    parser.add_argument("--since", type=parse_date, default=None, help="Only messages sent on or after this date (YYYY-MM-DD)")
+    parser.add_argument("--until", type=parse_date, default=None, help="Only messages sent before this date (YYYY-MM-DD)")
+    parser.add_argument("--limit", type=int, default=50, help="Maximum number of results, newest first")
+    args = parser.parse_intermixed_args()
+    path = f"{args.data_path}/archive.db" if os.path.isdir(args.data_path) else args.data_path
+    if not os.path.exists(path):
+        parser.error(f"{path} does not exist - run slack.py with --sqlite to create it")
+    db = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    db.row_factory = sqlite3.Row
+    return db, args, parser
+
+
+def quote_terms(text):
+    """Quotes each whitespace-separated term of a query as an FTS5 string, so
+    that punctuation in it is matched as text rather than read as syntax."""
+
+    return " ".join('"' + term.replace('"', '""') + '"' for term in text.split())
+
+
+def search(db, text=None, user=None, channel=None, since=None, until=None, limit=50):
+    """Finds messages and replies matching all of the given filters, newest
+    first. The filters are answered from the database's indexes, so nothing
+    else is read."""
+
+    conditions, params = [], []
+    if text:
+        conditions.append("m.id IN (SELECT rowid FROM message_text WHERE message_text MATCH ?)")
+        params.append(text)
+    if user:
+        conditions.append("""(m.user_id = ? OR m.bot_id = ?
+            OR m.user_id IN (SELECT id FROM people WHERE name = ? OR real_name = ? OR display_name = ?)
+            OR m.bot_id IN (SELECT id FROM bots WHERE name = ?))""")
+        params += [user] * 6
+    if channel:
+        conditions.append("m.channel_id IN (SELECT id FROM channels WHERE id = ? OR name = ? OR readable_name = ?)")
+        params += [channel] * 3
+    if since:
+        conditions.append("m.ts >= ?")
+        params.append(since)
+    if until:
+        conditions.append("m.ts < ?")
+        params.append(until)
+    query = f"""
+        SELECT m.ts, m.thread_ts, m.text,
+            coalesce(c.readable_name, c.name, m.channel_id) AS channel,
+            coalesce(p.name, b.name, m.user_id, m.bot_id, '') AS sender
+        FROM messages m
+        LEFT JOIN channels c ON c.id = m.channel_id
+        LEFT JOIN people p ON p.id = m.user_id
+        LEFT JOIN bots b ON b.id = m.bot_id
+        {'WHERE ' + ' AND '.join(conditions) if conditions else ''}
+        ORDER BY m.ts DESC
+        LIMIT ?
+    """
+    return db.execute(query, params + [limit]).fetchall()
+
+
+def format_result(result):
+    """Formats a search result like a line of a conversation's text file, with
+    the conversation it is from."""
+
+    reply = " (reply)" if result["thread_ts"] and result["thread_ts"] != result["ts"] else ""
+    return f"{format_timestamp(result)}: {result['channel']}{reply}: [{result['sender']}] {result['text']}"
+
+
+if __name__ == "__main__":
+    main()
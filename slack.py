@@ -1,54 +1,182 @@
 import argparse
+import base64
+import bisect
+import hashlib
 import os
 import json
-import urllib.request
+import multiprocessing
+import sqlite3
 import urllib.parse
+import urllib.request
+import http.client
+import itertools
+import ssl
+import sys
+import zlib
 import time
-import random
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 
-sleep_time = 20
-
-opener = urllib.request.build_opener(type(
-    "NoRaise", (urllib.request.HTTPErrorProcessor,),
-    {"http_response": lambda self, req, res: res, "https_response": lambda self, req, res: res}
-))
+METHOD_TIERS = {
+    "users.conversations": 3,
+    "client.userBoot": 3,
+    "conversations.view": 3,
+    "conversations.history": 3,
+    "conversations.replies": 3,
+    "users.info": 4,
+    "users.list": 2,
+    "bots.info": 3,
+}
+TIER_RATES = {1: 1 / 60, 2: 20 / 60, 3: 50 / 60, 4: 100 / 60}
+DEFAULT_RETRY_AFTER = 20
+CHUNK_SIZE = 1024 * 1024
+PAGE_SIZE = 999
+DIRECTORY_PAGE_SIZE = 1000
+
+output_lock = threading.Lock()
+log_context = threading.local()
+
+USER_AGENT = f"Python-urllib/{sys.version_info[0]}.{sys.version_info[1]}"
+REDIRECT_STATUSES = {301, 302, 303, 307, 308}
+MAX_IDLE_CONNECTIONS = 16
+IDLE_TIMEOUT = 4
+REQUEST_TIMEOUT = 60
+LATENCY_BUCKETS_MS = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+PROGRESS_INTERVAL = 30
+
+SEARCH_SCHEMA = """
+CREATE TABLE IF NOT EXISTS channels (
+    id TEXT PRIMARY KEY, name TEXT, readable_name TEXT, type TEXT, created INTEGER,
+    message_count INTEGER, latest_ts TEXT
+);
+CREATE TABLE IF NOT EXISTS people (id TEXT PRIMARY KEY, name TEXT, real_name TEXT, display_name TEXT);
+CREATE TABLE IF NOT EXISTS bots (id TEXT PRIMARY KEY, name TEXT);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY, channel_id TEXT NOT NULL, ts TEXT NOT NULL, thread_ts TEXT,
+    user_id TEXT, bot_id TEXT, text TEXT, reply_count INTEGER NOT NULL DEFAULT 0,
+    UNIQUE (channel_id, ts)
+);
+CREATE VIEW IF NOT EXISTS replies AS SELECT * FROM messages WHERE thread_ts IS NOT NULL AND thread_ts != ts;
+CREATE TABLE IF NOT EXISTS reactions (channel_id TEXT NOT NULL, ts TEXT NOT NULL, name TEXT NOT NULL, user_id TEXT);
+CREATE TABLE IF NOT EXISTS files (
+    id TEXT, channel_id TEXT NOT NULL, ts TEXT NOT NULL, name TEXT, title TEXT, filetype TEXT, size INTEGER
+);
+CREATE INDEX IF NOT EXISTS messages_ts ON messages (ts);
+CREATE INDEX IF NOT EXISTS messages_user ON messages (user_id, ts);
+CREATE INDEX IF NOT EXISTS messages_bot ON messages (bot_id, ts);
+CREATE INDEX IF NOT EXISTS messages_thread ON messages (channel_id, thread_ts);
+CREATE INDEX IF NOT EXISTS reactions_message ON reactions (channel_id, ts);
+CREATE INDEX IF NOT EXISTS reactions_user ON reactions (user_id);
+CREATE INDEX IF NOT EXISTS files_message ON files (channel_id, ts);
+CREATE VIRTUAL TABLE IF NOT EXISTS message_text USING fts5(text, content='messages', content_rowid='id');
+"""
 
 def main():
-    data, output_path, channel_id, channel_type = parse_args()
+    data, output_path, args = parse_args()
+    export_workspace(data, output_path, args)
+
+
+def export_workspace(data, output_path, args):
+    """Exports a workspace into an output directory, with the options parsed
+    by parse_args. Everything it uses - the rate limiter, pools, stats and
+    caches - is module-level, so each workspace exported at once needs a
+    process of its own."""
+
     output = load_output(output_path, data)
-    new_channels = get_channels(data, channel_id=channel_id, channel_type=channel_type)
+    if args.export_json:
+        export_single_file(output, output_path)
+        return
+    new_channels = get_channels(data, channel_id=args.channel, channel_type=args.type)
     for ch_id, ch_data in new_channels.items():
         if ch_id in output["channels"]:
             output["channels"][ch_id].update(ch_data)
         else:
             output["channels"][ch_id] = ch_data
     save_output(output, output_path)
+    downloads.workers = args.download_workers
+    reply_pool.workers = args.reply_workers
+    window_pool.workers = args.windows
+    if args.max_bandwidth:
+        bandwidth.rate = args.max_bandwidth * 1000 * 1000
+    directory.load(f"{output_path}/people_cache.json", args.people_ttl * 3600)
+    blobs.load(f"{output_path}/slack_files")
+    blobs.refresh = args.refresh_images
+    resume_downloads(data)
     output["people"] = {
         **output["people"],
         **get_users(output["channels"], data, output_path)
     }
     save_output(output, output_path)
-    for channel in output["channels"].values():
-        if channel_id and channel["id"] != channel_id:
-            continue
-        if "messages" not in channel:
-            process_conversation(channel, data, output, output_path)
-
-
-def parse_args():
-    """Parses the CLI arguments to produce the data config file, and the path
-    for the output directory."""
+    if args.sqlite:
+        search_index.open(f"{output_path}/archive.db")
+        search_index.sync(output, output_path)
+    channels = [
+        channel for channel in output["channels"].values()
+        if (not args.channel or channel["id"] == args.channel)
+        and needs_fetch(channel, args.update, args.since, args.until)
+    ]
+    stats.channels_total = len(channels)
+    try:
+        export_conversations(channels, data, output, output_path, args.thread_days, workers=args.workers, since=args.since, until=args.until, text=not args.no_text)
+        if args.refresh_images:
+            refresh_photos(output, data, output_path)
+            refresh_reactions(data)
+    finally:
+        window_pool.wait()
+        reply_pool.wait()
+        downloads.wait()
+        blobs.log_refreshed()
+        blobs.save()
+        search_index.close()
+        if args.stats_json:
+            with atomic_write(args.stats_json) as f:
+                json.dump(stats.report(), f, indent=4)
+
+
+def parse_args(argv=None):
+    """Parses the CLI arguments, or argv if given, to produce the data config
+    file, the path for the output directory, and the remaining options.
+    Slack's bounds are exclusive, so --since is moved back a microsecond to
+    include messages sent at exactly midnight."""
 
     parser = argparse.ArgumentParser()
     parser.add_argument("data_path", type=str)
     parser.add_argument("output_path", type=str)
     parser.add_argument("--channel", type=str, default=None, help="Only process the channel with this ID")
     parser.add_argument("--type", type=str, default=None, choices=["public_channel", "private_channel", "im", "mpim"], help="Only fetch channels of this type")
-    args = parser.parse_args()
+    parser.add_argument("--update", action="store_true", help="Fetch new messages for channels that have already been downloaded")
+    parser.add_argument("--thread-days", type=float, default=30, help="When updating, how many days back to check existing threads for new replies")
+    parser.add_argument("--workers", type=int, default=1, help="Number of conversations to download at once")
+    parser.add_argument("--windows", type=int, default=1, help="Number of time windows to split each conversation's history into, which are fetched at once")
+    parser.add_argument("--since", type=parse_date, default=None, help="Only fetch messages from this date (YYYY-MM-DD) onwards")
+    parser.add_argument("--until", type=parse_date, default=None, help="Only fetch messages from before this date (YYYY-MM-DD)")
+    parser.add_argument("--reply-workers", type=int, default=1, help="Number of threads to download replies for at once, while paging continues")
+    parser.add_argument("--download-workers", type=int, default=4, help="Number of files to download at once")
+    parser.add_argument("--max-bandwidth", type=float, default=None, help="Cap file downloads at this many megabytes a second")
+    parser.add_argument("--refresh-images", action="store_true", help="Check every profile photo and custom emoji already downloaded for changes, with conditional requests")
+    parser.add_argument("--people-ttl", type=float, default=24, help="How many hours cached users and bots are trusted for before being fetched again")
+    parser.add_argument("--no-text", action="store_true", help="Don't write a text file for each conversation, leaving transcripts to render.py")
+    parser.add_argument("--sqlite", action="store_true", help="Also keep the archive in a SQLite database, archive.db, with a full-text index for search.py")
+    parser.add_argument("--stats-json", type=str, default=None, help="Write a report of requests, timings and bytes transferred to this file at the end of the run")
+    parser.add_argument("--export-json", action="store_true", help="Write the archive out as a single slack.json file and exit")
+    args = parser.parse_args(argv)
     with open(args.data_path) as f:
         data = json.load(f)
-    return data, args.output_path.rstrip("/"), args.channel, args.type
+    if args.since:
+        args.since = f"{float(args.since) - 0.000001:.6f}"
+    return data, args.output_path.rstrip("/"), args
+
+
+def parse_date(value):
+    """Parses a YYYY-MM-DD date from the CLI, in local time, as a Slack
+    timestamp for midnight at the start of that day."""
+
+    try:
+        return f"{datetime.strptime(value, '%Y-%m-%d').timestamp():.6f}"
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid date: {value!r}, expected YYYY-MM-DD")
 
 
 def get_channels(data, channel_id=None, channel_type=None):
@@ -97,58 +225,117 @@ def get_enterprise_channels(data, types_set):
 
 
 def get_users(channels, data, output_path):
-    """Gets all users in the workspace as a mapping of user ID to user data. It
-    goes through all channel and conversation overviews to get this data."""
+    """Gets the users needed to name the conversations - DM partners, group
+    message members and Slackbot - as a mapping of user ID to user data. The
+    whole directory is cached first, from users.list or, where that isn't
+    allowed, the channel overviews, unless the cache is still fresh."""
 
     log("Downloading users")
+    if directory.listed_recently():
+        log(f"Using {len(directory.all('people'))} cached users", indent=1)
+    elif (listed := list_users(data)) is not None:
+        for user in listed.values():
+            directory.put("people", user["id"], user)
+        directory.listed_recently(True)
+    else:
+        get_channel_users(channels, data)
+        directory.listed_recently(True)
+    needed = {"USLACKBOT"}
+    for channel in channels.values():
+        needed.update([channel["user"]] if channel.get("user") else channel.get("members", []))
     users = {}
+    for user_id in needed:
+        if user := lookup_user(user_id, data):
+            users[user_id] = user
+    directory.save()
+    for user in users.values():
+        download_user_photo(user, data, output_path)
+    return users
+
+
+def list_users(data):
+    """Pages through the users.list API to get every user in the workspace, as
+    a mapping of user ID to user data, or None if the API isn't allowed."""
+
+    params = {"limit": DIRECTORY_PAGE_SIZE}
+    response = slack_post("users.list", data, params=params)
+    if response.get("ok") is False:
+        return None
+    members = response["members"]
+    cursor = response.get("response_metadata", {}).get("next_cursor", "")
+    while cursor:
+        response = slack_post("users.list", data, params={**params, "cursor": cursor})
+        members += response["members"]
+        cursor = response.get("response_metadata", {}).get("next_cursor", "")
+    return {user["id"]: user for user in members}
+
+
+def get_channel_users(channels, data):
+    """Caches the users in every channel from its conversations.view
+    overview."""
+
     for channel_id in channels:
         params = {"channel": channel_id}
         response = slack_post("conversations.view", data, params=params)
         for user in response["users"]:
-            users[user["id"]] = user
-    if "USLACKBOT" not in users:
-        response = slack_post("users.info", data, params={"user": "USLACKBOT"})
-        if response.get("ok") and "user" in response:
-            users["USLACKBOT"] = response["user"]
-    for user in users.values():
-        download_user_photo(user, data, output_path)
-    return users
+            directory.put("people", user["id"], user)
+
+
+def lookup_user(user_id, data):
+    """Looks up a single user, from the cache if it has a fresh copy and with
+    the users.info API otherwise. Returns None if they can't be found."""
+
+    if user := directory.get("people", user_id):
+        return user
+    response = slack_post("users.info", data, params={"user": user_id})
+    if response.get("ok") and "user" in response:
+        directory.put("people", user_id, response["user"])
+        return response["user"]
+
+
+def lookup_bot(bot_id, data):
+    """Looks up a single bot, from the cache if it has a fresh copy and with
+    the bots.info API otherwise. Returns None if it can't be found."""
+
+    if bot := directory.get("bots", bot_id):
+        return bot
+    response = slack_post("bots.info", data, params={"bot": bot_id})
+    if response.get("ok") and "bot" in response:
+        directory.put("bots", bot_id, response["bot"])
+        return response["bot"]
 
 
 def download_user_photo(user, data, output_path):
-    """Downloads a user's profile photo and saves it to slack_files/people/."""
+    """Downloads a user's profile photo into the blob store, unless the same
+    photo already has been and is current."""
 
     image_url = user.get("profile", {}).get("image_72") or user.get("icons", {}).get("image_72")
-    if not image_url:
-        return
-    ext = image_url.rsplit(".", 1)[-1].split("?")[0] if "." in image_url else "jpg"
-    filename = f"{output_path}/slack_files/people/{user['id']}.{ext}"
-    if os.path.exists(filename):
-        return
-    os.makedirs(f"{output_path}/slack_files/people", exist_ok=True)
-    response = slack_get(image_url, data)
-    with open(filename, "wb") as f:
-        f.write(response)
+    if image_url and not blobs.current("people", user["id"], url=image_url):
+        downloads.submit(image_url, "people", user["id"], data)
+
+
+def collect_senders(message, user_ids, bot_profiles):
+    """Adds the IDs of everyone who sent or reacted to a message or its replies
+    to user_ids, and the bot_ids of any bots to bot_profiles, mapped to their
+    embedded bot_profile if they have one."""
+
+    for msg in [message] + message.get("replies", []):
+        if uid := msg.get("user"):
+            user_ids.add(uid)
+        for reaction in msg.get("reactions", []):
+            user_ids.update(reaction.get("users", []))
+        if (bot_id := msg.get("bot_id")) and not bot_profiles.get(bot_id):
+            bot_profiles[bot_id] = msg.get("bot_profile")
 
 
-def get_missing_users(messages, data, known_users, output_path):
-    """Finds user IDs in messages that aren't already known, looks them up via
+def get_missing_users(user_ids, data, known_users, output_path):
+    """Looks up the user IDs that aren't already known via the cache or
     users.info, and returns a mapping of user_id to user data."""
 
-    user_ids = set()
-    for message in messages:
-        for msg in [message] + message.get("replies", []):
-            if uid := msg.get("user"):
-                user_ids.add(uid)
-            for reaction in msg.get("reactions", []):
-                user_ids.update(reaction.get("users", []))
-    user_ids -= set(known_users)
     users = {}
-    for uid in user_ids:
-        response = slack_post("users.info", data, params={"user": uid})
-        if response.get("ok") and "user" in response:
-            users[uid] = response["user"]
+    for uid in set(user_ids) - set(known_users):
+        if user := lookup_user(uid, data):
+            users[uid] = user
             log(f"Found user: {users[uid].get('name', uid)}", indent=1)
             download_user_photo(users[uid], data, output_path)
         else:
@@ -156,47 +343,435 @@ def get_missing_users(messages, data, known_users, output_path):
     return users
 
 
-def get_bots(messages, data, known_bots, output_path):
-    """Finds bot_ids in messages that aren't already known, looks them up via
-    embedded bot_profile or the bots.info API, and returns a mapping of bot_id
-    to bot data."""
+def get_bots(bot_profiles, data, known_bots, output_path):
+    """Looks up the bot_ids that aren't already known via their embedded
+    bot_profile, the cache or the bots.info API, and returns a mapping of
+    bot_id to bot data."""
 
-    bot_ids = {}
-    for message in messages:
-        for msg in [message] + message.get("replies", []):
-            bot_id = msg.get("bot_id")
-            if bot_id and bot_id not in known_bots and bot_id not in bot_ids:
-                bot_ids[bot_id] = msg.get("bot_profile")
     bots = {}
-    for bot_id, bot_profile in bot_ids.items():
+    for bot_id, bot_profile in bot_profiles.items():
+        if bot_id in known_bots:
+            continue
         if bot_profile:
             bots[bot_id] = bot_profile
+        elif bot := lookup_bot(bot_id, data):
+            bots[bot_id] = bot
         else:
-            response = slack_post("bots.info", data, params={"bot": bot_id})
-            if response.get("ok") and "bot" in response:
-                bots[bot_id] = response["bot"]
-            else:
-                log(f"Could not find bot: {bot_id}", indent=1)
-                continue
+            log(f"Could not find bot: {bot_id}", indent=1)
+            continue
         log(f"Found bot: {bots[bot_id].get('name', bot_id)}", indent=1)
         download_user_photo(bots[bot_id], data, output_path)
     return bots
 
 
-def process_conversation(channel, data, output, output_path):
-    """Fully processes a conversation and updates the output object in place
-    with the downloaded messages. As a side effect it will update the output on
-    disk once completed, and save a text representation of the conversation."""
+def needs_fetch(channel, update=False, since=None, until=None):
+    """Returns whether a conversation needs fetching in a run: if it hasn't
+    been downloaded, if it was only downloaded over a range of time that
+    doesn't cover since to until, or, when updating, if what was downloaded
+    reaches up to the present."""
+
+    if "message_count" not in channel or not is_covered(channel, since, until):
+        return True
+    return update and not channel.get("fetched_until")
+
+
+def is_covered(channel, since=None, until=None):
+    """Returns whether a downloaded conversation covers the time range from
+    since to until - either because it was downloaded in full, or because
+    the range it was downloaded over, kept as fetched_since and
+    fetched_until, includes it."""
+
+    fetched_since, fetched_until = channel.get("fetched_since"), channel.get("fetched_until")
+    if fetched_since and not (since and float(since) >= float(fetched_since)):
+        return False
+    return not fetched_until or bool(until and float(until) <= float(fetched_until))
+
+
+def export_conversations(channels, data, output, output_path, thread_days, workers=1, since=None, until=None, text=True):
+    """Processes a list of conversations, either one after the other or, if
+    workers is more than one, several at once in a thread pool. Workers share
+    the module's rate limiter, and the output object is guarded by a lock."""
+
+    if workers <= 1:
+        for channel in channels:
+            process_conversation(channel, data, output, output_path, thread_days, since, until, text)
+        return
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(process_in_worker, channel, data, output, output_path, thread_days, since, until, text)
+            for channel in channels
+        ]
+        for future in as_completed(futures):
+            future.result()
+
+
+def process_in_worker(channel, data, output, output_path, thread_days, since=None, until=None, text=True):
+    """Runs process_conversation in a worker thread, prefixing everything it
+    logs with the channel ID so that interleaved output can be told apart."""
+
+    log_context.prefix = f"[{channel['id']}] "
+    try:
+        process_conversation(channel, data, output, output_path, thread_days, since, until, text)
+    finally:
+        log_context.prefix = ""
+
+
+def process_conversation(channel, data, output, output_path, thread_days=None, since=None, until=None, text=True):
+    """Fully processes a conversation, fetching its messages between since and
+    until into its own file and updating the output object in place. As a
+    side effect it will update the output on disk once completed, and save a
+    text representation of the conversation unless text is False. If the
+    conversation has already been downloaded, thread_days must be given."""
 
     readable_name = channel_readable_name(channel, output["people"])
-    log(readable_name)
-    messages = get_all_messages(channel["id"], data, output_path)
-    output["people"].update(get_missing_users(messages, data, output["people"], output_path))
-    output["bots"].update(get_bots(messages, data, output["bots"], output_path))
-    channel["readable_name"] = readable_name
-    channel["messages"] = messages
-    save_output(output, output_path)
-    save_conversation_to_text(messages, readable_name, output["people"], output["bots"], output_path)
+    renamed = channel.get("readable_name") != readable_name
+    downloaded = "message_count" in channel
+    update = downloaded and is_covered(channel, since, until)
+    if downloaded and not update:
+        since = since and channel.get("fetched_since") and min(since, channel["fetched_since"], key=float)
+        until = until and channel.get("fetched_until") and max(until, channel["fetched_until"], key=float)
+        log(f"{readable_name} (widening)")
+        oldest_ts, known = None, {}
+    elif update:
+        log(f"{readable_name} (updating)")
+        oldest_ts, known = get_update_window(channel, output_path, thread_days)
+    else:
+        log(readable_name)
+        oldest_ts, known = None, {}
+    if since and (not oldest_ts or since > oldest_ts):
+        oldest_ts = since
+    stats.channel_started(channel["id"], oldest_ts or channel.get("created"))
+    journal = Journal(output_path, channel["id"], oldest_ts=oldest_ts, latest_ts=until)
+    fetch_history(channel["id"], data, output_path, journal, oldest_ts=oldest_ts, latest_ts=until, known=known, created=channel.get("created"))
+    with stats.timed("save_channel"):
+        summary = compact_journal(journal, output_path, channel["id"], known=known, merge=downloaded)
+    changed = summary is not None
+    if not changed:
+        summary = {"count": channel["message_count"], "new": 0, "latest_ts": None, "users": set(), "bots": {}}
+    if update:
+        log(f"{summary['new']} new message{'' if summary['new'] == 1 else 's'}{'' if changed else ', nothing changed'}", indent=1)
+    with output_lock:
+        known_people, known_bots = set(output["people"]), set(output["bots"])
+    people = get_missing_users(summary["users"], data, known_people, output_path)
+    bots = get_bots(summary["bots"], data, known_bots, output_path)
+    directory.save()
+    with output_lock:
+        output["people"].update(people)
+        output["bots"].update(bots)
+        channel["readable_name"] = readable_name
+        channel["message_count"] = summary["count"]
+        if summary["latest_ts"]:
+            channel["latest_ts"] = summary["latest_ts"]
+        if not update:
+            for field, bound in (("fetched_since", since), ("fetched_until", until)):
+                if bound:
+                    channel[field] = bound
+                else:
+                    channel.pop(field, None)
+        with stats.timed("save_index"):
+            save_output(output, output_path)
+    with stats.timed("save_search"):
+        search_index.add_people(people, bots)
+        if changed:
+            search_index.add_channel(channel, iter_messages(output_path, channel["id"]))
+        else:
+            search_index.update_channel(channel)
+    remove_journal(output_path, channel["id"])
+    if text and (changed or renamed or not os.path.exists(text_path(readable_name, output_path))):
+        with stats.timed("save_text"):
+            save_conversation_to_text(iter_messages(output_path, channel["id"]), readable_name, output["people"], output["bots"], output_path)
+    stats.channel_finished(channel["id"])
+
+
+def get_update_window(channel, output_path, thread_days):
+    """Works out what to fetch for an already downloaded conversation, from
+    thread_days before its newest message. Returns the oldest_ts to fetch
+    from, and the stored messages after it mapped by timestamp."""
+
+    mark = channel.get("latest_ts")
+    if not mark:
+        return None, {}
+    oldest_ts = f"{float(mark) - thread_days * 86400:.6f}"
+    known = {}
+    for message in iter_messages_backwards(output_path, channel["id"]):
+        if message["ts"] <= oldest_ts:
+            break
+        known[message["ts"]] = message
+    return oldest_ts, known
+
+
+def fetch_history(channel_id, data, output_path, journal, oldest_ts=None, latest_ts=None, known=None, created=None):
+    """Pages through a channel's history between oldest_ts and latest_ts into
+    its journal, in as many time windows at once as the window pool has
+    workers, along with the replies, files and emoji. Returns once every
+    reply has been fetched."""
+
+    windows = journal.windows
+    if windows is None:
+        windows = [(oldest_ts, latest_ts)]
+        if window_pool.workers > 1 and not journal.pages:
+            newest_ts = get_newest_ts(channel_id, data, oldest_ts, latest_ts)
+            windows = history_windows(oldest_ts, latest_ts, created, newest_ts, window_pool.workers)
+        journal.set_windows(windows)
+    stats.channel_windows(channel_id, windows)
+    if len(windows) == 1:
+        pending = fetch_window(channel_id, data, output_path, journal, 0, known)
+    else:
+        futures = [
+            window_pool.submit(fetch_window, channel_id, data, output_path, journal, index, known)
+            for index in range(len(windows))
+        ]
+        pending = [reply for future in futures for reply in future.result()]
+    for future in pending:
+        future.result()
+
+
+def get_newest_ts(channel_id, data, oldest_ts=None, latest_ts=None):
+    """Probes for the timestamp of the newest message in a channel between
+    oldest_ts and latest_ts, or None if there are none."""
+
+    params = {"channel": channel_id, "limit": 1}
+    if latest_ts: params["latest"] = latest_ts
+    if oldest_ts: params["oldest"] = oldest_ts
+    messages = slack_post("conversations.history", data, params=params)["messages"]
+    return messages[0]["ts"] if messages else None
+
+
+def history_windows(oldest_ts, latest_ts, created, newest_ts, count):
+    """Splits a channel's history between oldest_ts and latest_ts into count
+    windows covering equal amounts of time, from its creation to its newest
+    message, as pairs of oldest and latest bounds, newest first."""
+
+    start = max(float(oldest_ts or 0), float(created or 0))
+    end = float(newest_ts or 0) + 1
+    if count <= 1 or not start or end - start < count:
+        return [(oldest_ts, latest_ts)]
+    step = (end - start) / count
+    windows = []
+    lower = oldest_ts
+    for boundary in (int(start + step * index) for index in range(1, count)):
+        windows.append((lower, f"{boundary}.000000"))
+        lower = f"{boundary - 1}.999999"
+    windows.append((lower, latest_ts))
+    return windows[::-1]
+
+
+def fetch_window(channel_id, data, output_path, journal, index, known=None):
+    """Pages through one of the time windows of a channel's history, as
+    fetch_history describes, returning the futures for any replies which are
+    still downloading."""
+
+    pending = []
+    window = f"window {index + 1}/{len(journal.windows)}" if len(journal.windows) > 1 else ""
+    if replayed := len(journal.pages.get(index, [])):
+        log(f"Resuming {window + ' ' if window else ''}from journal after {replayed} page{'' if replayed == 1 else 's'}", indent=1)
+    for page, (messages, cursor, replayed) in enumerate(iter_history_pages(channel_id, data, journal, index), start=1):
+        log(f"{window.capitalize()}, page {page}" if window else f"Page {page}", indent=1)
+        for message in messages:
+            if future := check_replies(message, channel_id, data, output_path, known=known, journal=journal):
+                pending.append(future)
+            check_files(message, data, output_path)
+            check_reactions(message, data, output_path)
+        if not replayed:
+            journal.add_page(messages, cursor, window=index)
+        stats.page(channel_id, messages, cursor, window=index)
+        pending = [future for future in pending if not future.done() or future.result()]
+    return pending
+
+
+def iter_history_pages(channel_id, data, journal, index=0):
+    """Yields the pages of one of the time windows of a channel's history,
+    newest first, as the messages, the cursor for the next page, and whether
+    the page came from the journal. Pages already in the journal are read
+    from it, and paging carries on from the last one's cursor."""
+
+    oldest_ts, latest_ts = journal.windows[index]
+    cursor = None
+    replayed = list(journal.pages.get(index, []))
+    for offset, cursor in replayed:
+        yield journal.read(offset)["page"], cursor, True
+    if replayed and not cursor:
+        return
+    while True:
+        messages, cursor = get_messages_page(channel_id, data, latest_ts=latest_ts, oldest_ts=oldest_ts, cursor=cursor)
+        yield messages, cursor, False
+        if not cursor:
+            return
+
+
+def compact_journal(journal, output_path, channel_id, known=None, merge=False):
+    """Writes a channel's file from its journal, merging in the messages
+    already in it if merge is True. Returns a summary of what was written,
+    or None if nothing fetched differs from the stored copies in known."""
+
+    known = known or {}
+    if merge and all(known.get(message["ts"]) == message for message in iter_journal_messages(journal, known)):
+        return None
+    summary = {"count": 0, "new": 0, "latest_ts": None, "users": set(), "bots": {}}
+    stored = iter_messages(output_path, channel_id) if merge else iter(())
+    fetched = iter_journal_messages(journal, known)
+    os.makedirs(f"{output_path}/channels", exist_ok=True)
+    with atomic_write(f"{output_path}/channels/{channel_id}.jsonl") as f:
+        for message, new in merge_sorted(stored, fetched):
+            f.write(json.dumps(message) + "\n")
+            summary["count"] += 1
+            summary["new"] += int(new)
+            summary["latest_ts"] = message["ts"]
+            collect_senders(message, summary["users"], summary["bots"])
+    return summary
+
+
+def iter_journal_messages(journal, known):
+    """Yields the messages in a journal oldest first, window by window, with
+    their replies attached from the journal or, for threads that haven't
+    changed, from the stored copies in known."""
+
+    last_ts = None
+    pages = [page for index in sorted(journal.pages, reverse=True) for page in reversed(journal.pages[index])]
+    for offset, _ in pages:
+        for message in reversed(journal.read(offset)["page"]):
+            if last_ts is not None and message["ts"] <= last_ts:
+                continue
+            last_ts = message["ts"]
+            if not message.get("reply_count"):
+                message["replies"] = []
+            elif message["ts"] in journal.replies:
+                message["replies"] = journal.read(journal.replies[message["ts"]])["messages"]
+            else:
+                message["replies"] = known.get(message["ts"], {}).get("replies", [])
+            yield message
+
+
+def merge_sorted(stored, fetched):
+    """Merges two iterables of messages which are each sorted by timestamp,
+    yielding every message once along with whether it is new. Fetched copies
+    replace stored ones, and stored messages which no longer come back from
+    Slack are kept."""
+
+    stored, fetched = iter(stored), iter(fetched)
+    old, new = next(stored, None), next(fetched, None)
+    while old is not None or new is not None:
+        if new is None or (old is not None and old["ts"] < new["ts"]):
+            yield old, False
+            old = next(stored, None)
+            continue
+        if old is not None and old["ts"] == new["ts"]:
+            yield new, False
+            old = next(stored, None)
+        else:
+            yield new, True
+        new = next(fetched, None)
+
+
+def merge_messages(stored, fetched):
+    """Merges freshly fetched messages into a stored list of messages, keyed by
+    timestamp. Fetched copies replace stored ones, and stored messages which
+    no longer come back from Slack are kept."""
+
+    merged = {message["ts"]: message for message in stored}
+    merged.update({message["ts"]: message for message in fetched})
+    return sorted(merged.values(), key=lambda x: x["ts"])
+
+
+class Journal:
+    """An append-only log of the history pages and thread replies fetched for a
+    channel so far, one JSON object per line, so that an interrupted download
+    can carry on from the last page. Only the byte offsets of entries are
+    kept in memory, and entries can be added from several threads at once."""
+
+    def __init__(self, output_path, channel_id, oldest_ts=None, latest_ts=None):
+        self.path = journal_path(output_path, channel_id)
+        self.lock = threading.Lock()
+        self.windows = None
+        self.pages = {}
+        self.replies = {}
+        header = {"oldest": oldest_ts}
+        if latest_ts:
+            header["latest"] = latest_ts
+        if os.path.exists(self.path):
+            self.replay(header)
+        if not os.path.exists(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.append(header)
+
+    def replay(self, header):
+        """Finds the pages and replies in an existing journal."""
+
+        complete = 0
+        with open(self.path, "rb") as f:
+            while line := f.readline():
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                if not line.endswith(b"\n"):
+                    break
+                if complete == 0 and entry != header:
+                    self.windows, self.pages, self.replies = None, {}, {}
+                    os.remove(self.path)
+                    return
+                if "windows" in entry:
+                    self.windows = [tuple(window) for window in entry["windows"]]
+                elif "page" in entry:
+                    self.pages.setdefault(entry.get("window", 0), []).append((complete, entry["cursor"]))
+                elif "replies" in entry:
+                    self.replies[entry["replies"]] = complete
+                complete = f.tell()
+        with open(self.path, "r+b") as f:
+            f.truncate(complete)
+
+    def append(self, entry):
+        """Writes a single entry to the end of the journal, returning the byte
+        offset it was written at."""
+
+        line = (json.dumps(entry) + "\n").encode()
+        with self.lock, open(self.path, "ab") as f:
+            offset = f.seek(0, os.SEEK_END)
+            f.write(line)
+        return offset
+
+    def read(self, offset):
+        """Reads the entry at a byte offset."""
+
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            return json.loads(f.readline())
+
+    def set_windows(self, windows):
+        """Records the time windows the channel's history is split into."""
+
+        self.append({"windows": windows})
+        self.windows = windows
+
+    def add_page(self, messages, cursor, window=0):
+        """Records a page of messages from one of the time windows, without
+        their replies, and the cursor for the next page."""
+
+        page = [{key: value for key, value in message.items() if key != "replies"} for message in messages]
+        offset = self.append({"page": page, "cursor": cursor, "window": window})
+        with self.lock:
+            self.pages.setdefault(window, []).append((offset, cursor))
+
+    def add_replies(self, ts, replies):
+        """Records the replies to the message with the given timestamp."""
+
+        offset = self.append({"replies": ts, "messages": replies})
+        with self.lock:
+            self.replies[ts] = offset
+
+
+def journal_path(output_path, channel_id):
+    """Returns the path of a channel's journal."""
+
+    return f"{output_path}/journal/{channel_id}.jsonl"
+
+
+def remove_journal(output_path, channel_id):
+    """Removes a channel's journal once its messages have been saved."""
+
+    path = journal_path(output_path, channel_id)
+    if os.path.exists(path):
+        os.remove(path)
 
 
 def channel_readable_name(channel, users):
@@ -234,137 +809,1341 @@ def format_timestamp(message):
     return datetime.fromtimestamp(float(message["ts"])).strftime("%Y-%m-%d %H:%M:%S")
 
 
-def get_all_messages(channel_id, data, output_path, reply_ts=None):
-    """Gets all messages in a thread, whether for a channel or the replies to a
-    single message. It will download all files attached to the messages, and
-    find all replies recursively."""
+def get_replies(channel_id, reply_ts, data, output_path, oldest_ts=None):
+    """Gets all replies to a message. It will download all files attached to
+    them, and find any replies to them recursively. If oldest_ts is given,
+    only replies after it are fetched. Pages are appended as they arrive and
+    the replies sorted once at the end. Replies which are being downloaded in
+    the background are waited for before returning."""
 
     page = 1
-    last_message_ts = None
+    cursor = None
     messages = []
+    pending = []
     while True:
-        new_messages = get_messages_page(channel_id, data, latest_ts=last_message_ts, reply_ts=reply_ts)
-        if not new_messages: break
-        if new_messages[-1]["ts"] == last_message_ts: break
-        if reply_ts and page == 1:
+        new_messages, cursor = get_messages_page(channel_id, data, reply_ts=reply_ts, oldest_ts=oldest_ts, cursor=cursor)
+        if page == 1:
             log(f"Getting replies to message {reply_ts}", indent=2)
-        elif reply_ts and page > 1:
-            log(f"Getting replies to message {reply_ts}, page {page}", indent=2)
         else:
-            log(f"Page {page}", indent=1)
-        new_messages = [message for message in new_messages if message.get("ts") != last_message_ts]
+            log(f"Getting replies to message {reply_ts}, page {page}", indent=2)
         for message in new_messages:
-            check_replies(message, channel_id, data, output_path)
+            if future := check_replies(message, channel_id, data, output_path):
+                pending.append(future)
             check_files(message, data, output_path)
             check_reactions(message, data, output_path)
         messages += new_messages
-        messages.sort(key=lambda x: x["ts"])
+        if not cursor: break
         page += 1
-        last_message_ts = messages[0]["ts"]
+    for future in pending:
+        future.result()
+    messages.sort(key=lambda x: x["ts"])
     return messages
 
 
-def get_messages_page(channel_id, data, latest_ts=None, reply_ts=None):
-    """Gets a single page of messages for a particular channel, at a particular
-    point in time."""
+def get_messages_page(channel_id, data, latest_ts=None, reply_ts=None, oldest_ts=None, cursor=None):
+    """Gets a single page of messages for a particular channel, optionally
+    bounded by latest_ts and oldest_ts, as the largest page Slack allows. It
+    returns the messages along with the cursor for the next page, which is
+    empty if this was the last one."""
+
+    path, params = messages_page_request(channel_id, latest_ts, reply_ts, oldest_ts, cursor)
+    return messages_page(slack_post(path, data, params=params), reply_ts)
+
+
+def messages_page_request(channel_id, latest_ts=None, reply_ts=None, oldest_ts=None, cursor=None):
+    """Returns the API method and parameters to get a page of messages."""
 
     path = "conversations.replies" if reply_ts else "conversations.history"
-    params = {"channel": channel_id}
+    params = {"channel": channel_id, "limit": PAGE_SIZE}
     if latest_ts: params["latest"] = latest_ts
+    if oldest_ts: params["oldest"] = oldest_ts
     if reply_ts: params["ts"] = reply_ts
-    messages = slack_post(path, data, params=params)["messages"]
-    if reply_ts: messages.pop(0)
-    return messages
+    if cursor: params["cursor"] = cursor
+    return path, params
 
 
-def check_replies(message, channel_id, data, output_path):
-    """Downloads any replies for a message, and adds them to the message."""
+def messages_page(response, reply_ts=None):
+    """Returns the messages in a page of messages, leaving out the message
+    replied to from a page of replies, and the cursor for the next page."""
 
-    if message.get("reply_count", 0) > 0:
-        message["replies"] = get_all_messages(channel_id, data, output_path, reply_ts=message["ts"])
-    else:
+    messages = response["messages"]
+    if reply_ts: messages = [message for message in messages if message.get("ts") != reply_ts]
+    return messages, response.get("response_metadata", {}).get("next_cursor", "")
+
+
+def check_replies(message, channel_id, data, output_path, known=None, journal=None):
+    """Downloads any replies for a message not already in the journal, and
+    adds them to the message, reusing the stored copy's in known if the
+    thread hasn't changed. If they are downloaded in the background by the
+    reply pool, the future for that is returned - unless this is already
+    running in one of its workers, which fetch nested replies themselves."""
+
+    stored = (known or {}).get(message["ts"])
+    if message.get("reply_count", 0) == 0:
+        message["replies"] = []
+        return
+    if journal and message["ts"] in journal.replies:
+        return
+    if stored and stored.get("latest_reply") == message.get("latest_reply") and stored.get("reply_count") == message.get("reply_count"):
+        message["replies"] = stored.get("replies", [])
+        return
+    if reply_pool.workers > 1 and not reply_pool.in_worker():
         message["replies"] = []
+        return reply_pool.submit(fetch_replies, message, channel_id, data, output_path, stored, journal)
+    fetch_replies(message, channel_id, data, output_path, stored, journal)
+
+
+def fetch_replies(message, channel_id, data, output_path, stored=None, journal=None):
+    """Downloads the replies to a message and attaches them to it. If there is
+    a stored copy of the message with replies, only newer ones are fetched and
+    merged in. The replies are recorded in the journal, if one is given."""
+
+    if stored and stored.get("replies"):
+        newer = get_replies(channel_id, message["ts"], data, output_path, oldest_ts=stored["replies"][-1]["ts"])
+        replies = merge_messages(stored["replies"], newer)
+    else:
+        replies = get_replies(channel_id, message["ts"], data, output_path)
+    if journal:
+        journal.add_replies(message["ts"], replies)
+    message["replies"] = replies
 
 
-def check_files(message, data, output_path):
-    """Downloads any files attached to a message, and saves them to disk. If the
-    file has already been downloaded, it will not be downloaded again."""
+def check_files(message, data, output_path, pool=None):
+    """Downloads any files attached to a message into the blob store, in the
+    background with the given pool of downloads, or the download pool. If
+    the file has already been downloaded, it will not be downloaded again."""
 
     for file in message.get("files", []):
         if not file.get("url_private_download"): continue
-        filename = f"{output_path}/slack_files/{file['id']}.{file['filetype']}"
-        if not os.path.exists(filename):
-            os.makedirs(f"{output_path}/slack_files", exist_ok=True)
-            log(f"Downloading file {filename}...", indent=2)
-            response = slack_get(file["url_private_download"], data)
-            with open(filename, "wb") as f:
-                f.write(response)
-            log(f"Downloaded file {filename}", indent=2)
+        if not blobs.current("files", file["id"]):
+            (pool or downloads).submit(file["url_private_download"], "files", file["id"], data, label=f"file {file['id']}.{file['filetype']}")
 
 
-def check_reactions(message, data, output_path):
-    """Downloads any custom emoji images from reactions on a message."""
+def check_reactions(message, data, output_path, pool=None):
+    """Downloads any custom emoji images from reactions on a message into the
+    blob store, as check_files does. An emoji is downloaded again if its URL
+    has changed, as it does when the emoji's image is replaced, or checked
+    for changes when refreshing images."""
 
     for reaction in message.get("reactions", []):
         url = reaction.get("url")
-        if not url:
-            continue
-        ext = url.rsplit(".", 1)[-1].split("?")[0] if "." in url else "png"
-        filename = f"{output_path}/slack_files/reactions/{reaction['name']}.{ext}"
-        if not os.path.exists(filename):
-            os.makedirs(f"{output_path}/slack_files/reactions", exist_ok=True)
-            log(f"Downloading reaction {reaction['name']}...", indent=2)
-            response = slack_get(url, data)
-            with open(filename, "wb") as f:
-                f.write(response)
+        if url and not blobs.current("reactions", reaction["name"], url=url):
+            (pool or downloads).submit(url, "reactions", reaction["name"], data, label=f"reaction {reaction['name']}")
+
+
+def refresh_photos(output, data, output_path):
+    """Checks the profile photo of everyone and every bot already in the
+    archive for changes, as download_user_photo does, using their cached
+    copy if it is fresh so that replaced photos are found."""
+
+    for user_id, user in output["people"].items():
+        download_user_photo(directory.get("people", user_id) or user, data, output_path)
+    for bot_id, bot in output["bots"].items():
+        download_user_photo(directory.get("bots", bot_id) or bot, data, output_path)
+
+
+def refresh_reactions(data, pool=None):
+    """Checks every custom emoji already downloaded for changes, including
+    those not used in any message fetched this run, as check_reactions does."""
+
+    for name, url in blobs.urls("reactions").items():
+        if not blobs.current("reactions", name, url=url):
+            (pool or downloads).submit(url, "reactions", name, data, label=f"reaction {name}")
+
+
+def resume_downloads(data, pool=None):
+    """Queues everything left in the blob store's queue by an earlier run -
+    downloads which failed or were still going when it ended - unless it has
+    been stored since."""
+
+    for (kind, key), (url, label) in list(blobs.queued.items()):
+        if blobs.current(kind, key, url=url):
+            blobs.unqueue(kind, key)
+        else:
+            (pool or downloads).submit(url, kind, key, data, label=label)
 
 
 def save_conversation_to_text(messages, name, people, bots, output_path):
     """Saves a conversation to a text file. It will format the messages in a
-    human-readable way, and save the file to the output path."""
+    human-readable way, and save the file to the output path. The messages
+    can be any iterable, and are written out as they are read."""
+
+    with atomic_write(text_path(name, output_path)) as f:
+        for index, line in enumerate(transcript_lines(messages, people, bots)):
+            f.write(f"\n{line}" if index else line)
+
+
+def text_path(name, output_path):
+    """Returns the path of a conversation's text file."""
+
+    return f"{output_path}/{name.replace(' ', '_').replace(',', '_')}.txt"
+
+
+def transcript_lines(messages, people, bots):
+    """Yields the lines of a conversation's text file."""
 
-    lines = []
     for message in messages:
-        lines.append(f"{format_timestamp(message)}: [{sender_name(message, people, bots)}] {message['text']}\n")
+        yield f"{format_timestamp(message)}: [{sender_name(message, people, bots)}] {message['text']}\n"
         for reply in message.get("replies", []):
-            lines.append(f"    [{sender_name(reply, people, bots)}] {reply['text']}")
-        lines.append("")
-    filename = name.replace(" ", "_").replace(",", "_")
-    with open(f"{output_path}/{filename}.txt", "w") as f:
-        f.write("\n".join(lines))
-    
-
-def slack_request(method, url, data, params=None, indent=1):
+            yield f"    [{sender_name(reply, people, bots)}] {reply['text']}"
+        yield ""
+
+
+class RateLimiter:
+    """A token bucket for each Slack API rate limit tier, shared by every
+    thread making requests. Each bucket starts at the published rate for its
+    tier and climbs with every successful request, up to max_multiplier times
+    that, as the limits Slack actually enforces are usually more generous. It
+    halves whenever Slack reports that it is being ratelimited."""
+
+    def __init__(self, rates=TIER_RATES, burst=3, max_multiplier=10):
+        self.lock = threading.Lock()
+        self.burst = burst
+        now = time.monotonic()
+        self.buckets = {
+            tier: {"base_rate": rate, "max_rate": rate * max_multiplier, "rate": rate, "tokens": 1, "updated": now}
+            for tier, rate in rates.items()
+        }
+
+    def bucket(self, api_method):
+        """Returns the bucket for the tier an API method belongs to."""
+
+        return self.buckets[METHOD_TIERS.get(api_method, 3)]
+
+    def acquire(self, api_method):
+        """Blocks until a request to the given API method can be made."""
+
+        while wait := self.reserve(api_method):
+            time.sleep(wait)
+
+    def reserve(self, api_method):
+        """Lets a request to the given API method through if it can be made
+        now, returning 0, or otherwise returns how many seconds to wait before
+        trying again, without blocking."""
+
+        bucket = self.bucket(api_method)
+        with self.lock:
+            now = time.monotonic()
+            elapsed = max(now - bucket["updated"], 0)
+            bucket["tokens"] = min(self.burst, bucket["tokens"] + elapsed * bucket["rate"])
+            bucket["updated"] = max(now, bucket["updated"])
+            if bucket["updated"] == now and bucket["tokens"] >= 1:
+                bucket["tokens"] -= 1
+                return 0
+            return bucket["updated"] - now + (1 - bucket["tokens"]) / bucket["rate"]
+
+    def succeeded(self, api_method):
+        """Records a successful request, letting the rate recover additively."""
+
+        bucket = self.bucket(api_method)
+        with self.lock:
+            bucket["rate"] = min(bucket["max_rate"], bucket["rate"] + bucket["base_rate"] / 10)
+
+    def ratelimited(self, api_method, retry_after):
+        """Records a ratelimited request. The tier's rate is halved and no
+        requests in it are let through for retry_after seconds."""
+
+        bucket = self.bucket(api_method)
+        with self.lock:
+            bucket["rate"] = max(bucket["rate"] / 2, bucket["base_rate"] / 2)
+            bucket["tokens"] = 0
+            bucket["updated"] = max(bucket["updated"], time.monotonic() + retry_after)
+
+
+limiter = RateLimiter()
+
+
+class BandwidthLimiter:
+    """A token bucket for the bytes of files downloaded, capping them at rate
+    bytes a second, or not at all if rate is None. Bytes are taken once they
+    have been read, leaving the bucket in debt that later downloads wait out.
+    A shared bucket keeps its state in shared memory, so that one cap covers
+    every process it is handed to."""
+
+    def __init__(self, rate=None, state=None):
+        self.rate = rate
+        self.state = state if state is not None else [0.0, time.monotonic()]
+        self.lock = state.get_lock() if state is not None else threading.Lock()
+
+    @classmethod
+    def shared(cls, rate, context=multiprocessing):
+        """Returns a bucket which can be shared with worker processes started
+        from the given multiprocessing context."""
+
+        return cls(rate, context.Array("d", [0.0, time.monotonic()]))
+
+    def acquire(self, size):
+        """Takes size bytes from the bucket, blocking until they are paid for."""
+
+        if wait := self.take(size):
+            with stats.timed("bandwidth_wait"):
+                time.sleep(wait)
+
+    def take(self, size):
+        """Takes size bytes from the bucket without blocking, returning how
+        many seconds to wait before they are paid for."""
+
+        if not self.rate:
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            tokens = min(self.rate, self.state[0] + max(now - self.state[1], 0) * self.rate) - size
+            self.state[0], self.state[1] = tokens, now
+        return max(-tokens / self.rate, 0)
+
+
+bandwidth = BandwidthLimiter()
+
+
+class Stats:
+    """Instrumentation for a run. It records the count, latency, failures,
+    retries and bytes of requests to each API method (and file host), the
+    time spent in phases such as waiting on the rate limiter or saving, and
+    how far through each channel the download is. The size of a channel
+    isn't known until it has been paged through, so it is estimated from how
+    much of the channel's lifetime the pages fetched so far cover, which lets
+    an overall ETA be logged as the run goes."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.last_progress = self.started
+        self.methods = {}
+        self.phases = {}
+        self.channels = {}
+        self.channels_total = 0
+        self.channels_done = 0
+
+    def request(self, method, seconds, size, failed=False, retried=False):
+        """Records a request to an API method or file host."""
+
+        with self.lock:
+            entry = self.methods.setdefault(method, {
+                "count": 0, "failed": 0, "retried": 0, "bytes": 0, "seconds": 0, "max_seconds": 0,
+                "histogram_ms": [0] * (len(LATENCY_BUCKETS_MS) + 1),
+            })
+            entry["count"] += 1
+            entry["failed"] += int(failed)
+            entry["retried"] += int(retried)
+            entry["bytes"] += size
+            entry["seconds"] += seconds
+            entry["max_seconds"] = max(entry["max_seconds"], seconds)
+            entry["histogram_ms"][bisect.bisect_left(LATENCY_BUCKETS_MS, seconds * 1000)] += 1
+
+    def add_time(self, phase, seconds):
+        """Adds time spent in a phase of the run."""
+
+        with self.lock:
+            self.phases[phase] = self.phases.get(phase, 0) + seconds
+
+    @contextmanager
+    def timed(self, phase):
+        """Records the time spent in a block as part of a phase."""
+
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add_time(phase, time.monotonic() - started)
+
+    def channel_started(self, channel_id, oldest_ts=None):
+        """Records that a channel has started downloading. oldest_ts is the
+        earliest its messages can be from, if known, such as when the channel
+        was created."""
+
+        with self.lock:
+            self.channels[channel_id] = {
+                "oldest": float(oldest_ts) if oldest_ts else None,
+                "windows": [(None, None)], "progress": {}, "fetched": 0, "estimate": 0, "done": False,
+            }
+
+    def channel_windows(self, channel_id, windows):
+        """Records the time windows a channel's history is split into."""
+
+        with self.lock:
+            if channel := self.channels.get(channel_id):
+                channel["windows"] = windows
+
+    def page(self, channel_id, messages, cursor, window=0):
+        """Records a page from one of the time windows of a channel's history,
+        and updates the estimate of how many messages the channel has."""
+
+        with self.lock:
+            channel = self.channels.get(channel_id)
+            if channel is None:
+                return
+            channel["fetched"] += len(messages)
+            progress = channel["progress"].setdefault(window, {"newest": None, "reached": None, "done": False})
+            if messages:
+                progress["newest"] = progress["newest"] or max(float(message["ts"]) for message in messages)
+                progress["reached"] = min(float(message["ts"]) for message in messages)
+            progress["done"] = not cursor
+            channel["estimate"] = estimate_channel(channel)
+        self.log_progress()
+
+    def channel_finished(self, channel_id):
+        """Records that a channel has been saved."""
+
+        with self.lock:
+            self.channels_done += 1
+            if channel := self.channels.get(channel_id):
+                channel["done"] = True
+                channel["estimate"] = channel["fetched"]
+        self.log_progress(force=True)
+
+    def progress(self):
+        """Estimates how many messages have been fetched and how many there
+        are in total, assuming channels not yet started are as big as the
+        average of those that have been."""
+
+        with self.lock:
+            fetched = sum(channel["fetched"] for channel in self.channels.values())
+            estimates = [channel["estimate"] for channel in self.channels.values()]
+            waiting = max(self.channels_total - len(estimates), 0)
+        average = sum(estimates) / len(estimates) if estimates else 0
+        return fetched, sum(estimates) + waiting * average
+
+    def log_progress(self, force=False):
+        """Logs the overall progress and ETA, at most every PROGRESS_INTERVAL
+        seconds unless forced."""
+
+        now = time.monotonic()
+        if not self.channels_total or (not force and now - self.last_progress < PROGRESS_INTERVAL):
+            return
+        self.last_progress = now
+        fetched, estimate = self.progress()
+        message = f"Progress: {self.channels_done}/{self.channels_total} channels, {fetched} messages"
+        if fetched and estimate > fetched:
+            eta = (estimate - fetched) / (fetched / (now - self.started))
+            message += f" of ~{int(estimate)}, ETA {format_duration(eta)}"
+        log(message)
+
+    def report(self):
+        """Returns everything recorded as a JSON-serialisable object."""
+
+        fetched, estimate = self.progress()
+        with self.lock:
+            return {
+                "wall_seconds": round(time.monotonic() - self.started, 3),
+                "channels": {"total": self.channels_total, "done": self.channels_done},
+                "messages": fetched,
+                "phases_seconds": {phase: round(seconds, 3) for phase, seconds in self.phases.items()},
+                "latency_buckets_ms": LATENCY_BUCKETS_MS,
+                "methods": {
+                    method: {**entry, "seconds": round(entry["seconds"], 3), "max_seconds": round(entry["max_seconds"], 3)}
+                    for method, entry in sorted(self.methods.items())
+                },
+            }
+
+
+stats = Stats()
+
+
+def estimate_channel(channel):
+    """Estimates how many messages a channel has from how much of the time
+    between its oldest possible message and its newest one the pages fetched
+    so far cover, assuming messages are spread evenly. Each time window
+    covers from its newest message down to the oldest reached so far, or to
+    its oldest bound once it is finished."""
+
+    windows = channel["windows"]
+    progress = channel["progress"]
+    if len(progress) == len(windows) and all(window["done"] for window in progress.values()):
+        return channel["fetched"]
+    newest = max((window["newest"] for window in progress.values() if window["newest"]), default=None)
+    if channel["oldest"] is None or not newest or newest <= channel["oldest"]:
+        return channel["fetched"] + PAGE_SIZE * (len(windows) - sum(window["done"] for window in progress.values()))
+    covered = 0
+    for index, window in progress.items():
+        if not window["newest"]:
+            continue
+        bottom = float(windows[index][0] or channel["oldest"]) if window["done"] else window["reached"]
+        covered += max(window["newest"] - bottom, 0)
+    if not covered:
+        return channel["fetched"] + PAGE_SIZE
+    return max(channel["fetched"] / min(covered / (newest - channel["oldest"]), 1), channel["fetched"] + 1)
+
+
+def format_duration(seconds):
+    """Formats a number of seconds as a short human-readable duration."""
+
+    seconds = int(seconds)
+    if seconds < 60:
+        return f"{seconds}s"
+    if seconds < 3600:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds // 3600}h{seconds // 60 % 60:02d}m"
+
+
+class PeopleCache:
+    """A local store of the people and bots fetched from Slack, kept next to
+    the archive so that re-runs don't need to fetch them again. Every entry
+    records when it was fetched and expires after ttl seconds, as does the
+    record of when the whole directory was last listed. Until load is called
+    nothing is cached."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.path = None
+        self.ttl = 0
+        self.entries = {"listed": 0, "people": {}, "bots": {}}
+        self.dirty = False
+
+    def load(self, path, ttl):
+        """Reads the cache from disk, if it exists."""
+
+        self.path, self.ttl = path, ttl
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def fresh(self, fetched):
+        """Returns whether something fetched at the given time is still fresh."""
+
+        return time.time() - fetched < self.ttl
+
+    def get(self, kind, id):
+        """Returns a cached person or bot, if there is a fresh copy."""
+
+        with self.lock:
+            entry = self.entries[kind].get(id)
+        if entry and self.fresh(entry["fetched"]):
+            return entry["data"]
+
+    def all(self, kind):
+        """Returns every fresh cached person or bot, as a mapping of ID to data."""
+
+        with self.lock:
+            entries = list(self.entries[kind].items())
+        return {id: entry["data"] for id, entry in entries if self.fresh(entry["fetched"])}
+
+    def put(self, kind, id, value):
+        """Stores a person or bot that has just been fetched."""
+
+        with self.lock:
+            self.entries[kind][id] = {"fetched": time.time(), "data": value}
+            self.dirty = True
+
+    def listed_recently(self, listed=False):
+        """Returns whether the whole directory was listed within the ttl. If
+        listed is True, it records that it just has been."""
+
+        with self.lock:
+            if listed:
+                self.entries["listed"] = time.time()
+                self.dirty = True
+        return self.fresh(self.entries["listed"])
+
+    def save(self):
+        """Writes the cache to disk, if anything has changed."""
+
+        with self.lock:
+            if not self.path or not self.dirty:
+                return
+            with atomic_write(self.path) as f:
+                json.dump(self.entries, f)
+            self.dirty = False
+
+
+directory = PeopleCache()
+
+
+class SearchIndex:
+    """A SQLite copy of the archive, with a table each for conversations,
+    messages (replies included, marked by their thread_ts), reactions, files,
+    people and bots, and a full-text index over the text of every message.
+    Each conversation is replaced as a whole once it has been saved, in a
+    single transaction, so the database never holds half a conversation.
+    Until open is called nothing is written."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connection = None
+
+    def open(self, path):
+        """Opens the database, creating it if it doesn't exist."""
+
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(SEARCH_SCHEMA)
+
+    def close(self):
+        """Closes the database, if it is open."""
+
+        with self.lock:
+            if self.connection:
+                self.connection.close()
+                self.connection = None
+
+    def sync(self, output, output_path):
+        """Brings the database up to date with the archive on disk, adding
+        all the people and bots, and any conversations which are missing or
+        have a different number of messages."""
+
+        if not self.connection:
+            return
+        self.add_people(output["people"], output["bots"])
+        with self.lock:
+            counts = dict(self.connection.execute("SELECT id, message_count FROM channels"))
+        for channel_id, channel in output["channels"].items():
+            if "message_count" in channel and counts.get(channel_id) != channel["message_count"]:
+                log(f"Indexing {channel.get('readable_name', channel_id)}")
+                self.add_channel(channel, iter_messages(output_path, channel_id))
+
+    def add_people(self, people, bots):
+        """Adds or updates people and bots."""
+
+        if not self.connection:
+            return
+        with self.lock, self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO people VALUES (?, ?, ?, ?)", (
+                (id, person.get("name"), person.get("real_name"), person.get("profile", {}).get("display_name"))
+                for id, person in people.items()
+            ))
+            self.connection.executemany("INSERT OR REPLACE INTO bots VALUES (?, ?)", (
+                (id, bot.get("name")) for id, bot in bots.items()
+            ))
+
+    def add_channel(self, channel, messages):
+        """Replaces a conversation and its messages, which can be any iterable
+        of messages with their replies attached."""
+
+        if not self.connection:
+            return
+        with self.lock, self.connection as db:
+            self.remove_messages(channel["id"])
+            for message in messages:
+                for msg in [message] + message.get("replies", []):
+                    self.add_message(channel["id"], msg)
+            db.execute("INSERT INTO message_text (rowid, text) SELECT id, text FROM messages WHERE channel_id = ?", (channel["id"],))
+            self.put_channel(channel)
+
+    def update_channel(self, channel):
+        """Updates a conversation's details, leaving its messages as they
+        are."""
+
+        if not self.connection:
+            return
+        with self.lock, self.connection:
+            self.put_channel(channel)
+
+    def put_channel(self, channel):
+        """Adds or replaces a conversation's row."""
+
+        if channel.get("is_im"):
+            kind = "im"
+        elif channel.get("is_mpim"):
+            kind = "mpim"
+        else:
+            kind = "private_channel" if channel.get("is_private") else "public_channel"
+        self.connection.execute("INSERT OR REPLACE INTO channels VALUES (?, ?, ?, ?, ?, ?, ?)", (
+            channel["id"], channel.get("name"), channel.get("readable_name"), kind, channel.get("created"),
+            channel.get("message_count"), channel.get("latest_ts"),
+        ))
+
+    def remove_messages(self, channel_id):
+        """Removes the messages of a conversation, and their full-text
+        entries, reactions and files."""
+
+        db = self.connection
+        db.execute("INSERT INTO message_text (message_text, rowid, text) SELECT 'delete', id, text FROM messages WHERE channel_id = ?", (channel_id,))
+        for table in ("messages", "reactions", "files"):
+            db.execute(f"DELETE FROM {table} WHERE channel_id = ?", (channel_id,))
+
+    def add_message(self, channel_id, message):
+        """Adds a single message, with its reactions and files."""
+
+        db = self.connection
+        ts = message["ts"]
+        db.execute("INSERT OR REPLACE INTO messages (channel_id, ts, thread_ts, user_id, bot_id, text, reply_count) VALUES (?, ?, ?, ?, ?, ?, ?)", (
+            channel_id, ts, message.get("thread_ts"), message.get("user"), message.get("bot_id"),
+            message.get("text"), message.get("reply_count", 0),
+        ))
+        db.executemany("INSERT INTO reactions VALUES (?, ?, ?, ?)", (
+            (channel_id, ts, reaction["name"], user)
+            for reaction in message.get("reactions", []) for user in reaction.get("users", [])
+        ))
+        db.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?)", (
+            (file.get("id"), channel_id, ts, file.get("name"), file.get("title"), file.get("filetype"), file.get("size"))
+            for file in message.get("files", [])
+        ))
+
+
+search_index = SearchIndex()
+
+
+class WorkerPool:
+    """A pool of threads which runs tasks in the background. The threads are
+    only started when the first task is submitted, so the number of workers
+    can be changed until then. At most twice as many tasks as workers are
+    queued or running at once, and submitting more blocks until one is done,
+    so that whatever is queueing them can't run ahead of the pool."""
+
+    def __init__(self, workers=4, name="worker"):
+        self.workers = workers
+        self.name = name
+        self.executor = None
+        self.slots = None
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def submit(self, fn, *args):
+        """Queues a task, returning its future. Blocks while the pool is full,
+        unless called from one of the pool's own workers - which shouldn't
+        then wait for the task, as every worker may be doing the same."""
+
+        with self.lock:
+            self.start()
+            slots = self.slots
+        blocking = not self.in_worker()
+        if blocking:
+            slots.acquire()
+        try:
+            with self.lock:
+                self.start()
+                future = self.executor.submit(self.run, fn, *args)
+        except BaseException:
+            if blocking:
+                slots.release()
+            raise
+        if blocking:
+            future.add_done_callback(lambda future: slots.release())
+        return future
+
+    def start(self):
+        """Starts the pool's threads if they aren't running, which must be done
+        holding the lock."""
+
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=self.name)
+            self.slots = threading.BoundedSemaphore(self.workers * 2)
+
+    def in_worker(self):
+        """Returns whether this is running in one of the pool's workers."""
+
+        return getattr(self.local, "worker", False)
+
+    def run(self, fn, *args):
+        """Runs a task in one of the pool's workers."""
+
+        self.local.worker = True
+        return fn(*args)
+
+    def wait(self):
+        """Blocks until every queued task has finished."""
+
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor:
+            executor.shutdown(wait=True)
+
+
+class DownloadPool(WorkerPool):
+    """A pool of threads which downloads files in the background, so that slow
+    or large files don't hold up paging through messages. Each file is only
+    queued once, however many messages refer to it, and a file which failed
+    to download - such as a deleted emoji - isn't tried again this run. Queued
+    files are recorded in the blob store until they have downloaded."""
+
+    def __init__(self, workers=4):
+        super().__init__(workers, name="download")
+        self.pending = {}
+        self.failed = set()
+
+    def submit(self, url, kind, key, data, label=None):
+        """Queues a file to be downloaded into the blob store under kind and
+        key, unless it already is, or has already failed."""
+
+        with self.lock:
+            if (kind, key) in self.pending or (kind, key) in self.failed:
+                return
+            self.pending[(kind, key)] = None
+        blobs.queue(kind, key, url, label)
+        future = super().submit(download_file, url, kind, key, data, label)
+        future.add_done_callback(lambda future: self.done(kind, key, future.result()))
+
+    def done(self, kind, key, downloaded):
+        """Forgets about a queued file once its download has finished,
+        remembering it if it failed. It stays in the blob store's queue only
+        if it failed but could be downloaded another time."""
+
+        with self.lock:
+            self.pending.pop((kind, key), None)
+            if not downloaded:
+                self.failed.add((kind, key))
+        if downloaded is not False:
+            blobs.unqueue(kind, key)
+
+    def wait(self):
+        """Blocks until every queued download has finished."""
+
+        if self.pending:
+            log(f"Waiting for {len(self.pending)} downloads to finish")
+        super().wait()
+
+
+downloads = DownloadPool()
+reply_pool = WorkerPool(workers=1, name="replies")
+window_pool = WorkerPool(workers=1, name="windows")
+
+
+def download_file(url, kind, key, data, label=None):
+    """Downloads a single file into the blob store, conditional on it having
+    changed if it has been downloaded from the same URL before. Failures are
+    logged rather than raised. Returns True if it was downloaded, False if
+    it failed, or None if it failed for good, such as with a 404."""
+
+    if label:
+        log(f"Downloading {label}...", indent=2)
+    status = None
+    def save(response):
+        nonlocal status
+        status = response.status
+        return blobs.add(response, kind, key, url)
+    try:
+        headers = blobs.conditional_headers(kind, key, url)
+        size = slack_get(url, data, headers=headers, save=save)
+    except Exception as e:
+        return download_finished(url, label, error=e)
+    return download_finished(url, label, size, status)
+
+
+def download_finished(url, label=None, size=None, status=None, error=None):
+    """Logs how a download went, returning whether it was stored, or None if
+    its response's status means it never will be."""
+
+    if size is not None:
+        if label:
+            log(f"Downloaded {label}", indent=2)
+        return True
+    log(f"Could not download {label or url}{f': {error}' if error else f' ({status})' if status else ''}", indent=2)
+    if status and 400 <= status < 500 and status != 429:
+        return None
+    return False
+
+
+class BlobStore:
+    """A content-addressed store for downloaded files, emoji and profile
+    photos, each kept once under the SHA-256 of its contents, with a manifest
+    mapping their IDs to blobs, and a queue of downloads which haven't
+    finished yet. If refresh is True, emoji and photos are checked for
+    changes once per run. Until load is called nothing is stored."""
+
+    KINDS = ("files", "reactions", "people")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.root = None
+        self.manifest = {kind: {} for kind in self.KINDS}
+        self.dirty = False
+        self.refresh = False
+        self.refreshed = {}
+        self.queued = {}
+        self.temp_names = itertools.count()
+
+    def load(self, root):
+        """Reads the manifest from disk, if it exists, along with anything
+        recorded in its log since it was last written, or otherwise moves any
+        files saved by name into the store, and the queue of unfinished
+        downloads. Temporary files left by an interrupted run are removed."""
+
+        self.root = root
+        path = f"{root}/manifest.json"
+        if os.path.exists(path):
+            with open(path) as f:
+                self.manifest.update(json.load(f))
+        for kind, key, entry in read_manifest_log(root):
+            self.manifest[kind][key] = entry
+            self.dirty = True
+        if not os.path.exists(path) and os.path.isdir(root):
+            self.import_legacy()
+        self.queued = read_queue_log(root)
+        self.remove_temp_files()
+        self.save()
+
+    def save(self):
+        """Writes the manifest to disk, if anything has changed, and empties
+        its log. The queue's log is rewritten with only what is still
+        queued."""
+
+        with self.lock:
+            if not self.root:
+                return
+            self.save_queue()
+            if not self.dirty:
+                return
+            with atomic_write(f"{self.root}/manifest.json") as f:
+                json.dump(self.manifest, f)
+            if os.path.exists(f"{self.root}/manifest.log"):
+                os.remove(f"{self.root}/manifest.log")
+            self.dirty = False
+
+    def save_queue(self):
+        """Rewrites the queue's log with only what is still queued, which must
+        be done holding the lock."""
+
+        path = f"{self.root}/queue.log"
+        if not self.queued:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        with atomic_write(path) as f:
+            for (kind, key), (url, label) in self.queued.items():
+                f.write(json.dumps(["queued", kind, key, url, label]) + "\n")
+
+    def queue(self, kind, key, url, label=None):
+        """Records that something is queued to be downloaded, appending it to
+        the queue's log straight away so that it is downloaded on the next
+        run if this one ends first."""
+
+        self.log_queue(["queued", kind, key, url, label], kind, key, (url, label))
+
+    def unqueue(self, kind, key):
+        """Records that something queued has been downloaded."""
+
+        self.log_queue(["done", kind, key], kind, key)
+
+    def log_queue(self, line, kind, key, queued=None):
+        """Adds or removes something in the queue, and appends the change to
+        the queue's log."""
+
+        with self.lock:
+            if queued:
+                self.queued[(kind, key)] = queued
+            elif self.queued.pop((kind, key), None) is None:
+                return
+            if self.root:
+                os.makedirs(self.root, exist_ok=True)
+                with open(f"{self.root}/queue.log", "a") as f:
+                    f.write(json.dumps(line) + "\n")
+
+    def remove_temp_files(self):
+        """Removes downloads which were still being written when a run was
+        interrupted."""
+
+        if not os.path.isdir(f"{self.root}/blobs"):
+            return
+        for entry in os.scandir(f"{self.root}/blobs"):
+            if entry.is_file() and entry.name.endswith(".part"):
+                os.remove(entry.path)
+
+    def current(self, kind, key, url=None):
+        """Returns whether something is already stored, and if a URL is given,
+        whether it was downloaded from that URL. When refreshing, emoji and
+        photos aren't current until they have been checked this run."""
+
+        with self.lock:
+            entry = self.manifest[kind].get(key)
+            if entry is None or (url is not None and entry.get("url") != url):
+                return False
+            return not self.refresh or kind == "files" or (kind, key) in self.refreshed
+
+    def urls(self, kind):
+        """Returns the URL everything of a kind was downloaded from, by key,
+        leaving out anything stored without one."""
+
+        with self.lock:
+            return {key: entry["url"] for key, entry in self.manifest[kind].items() if entry.get("url")}
+
+    def conditional_headers(self, kind, key, url):
+        """Returns the headers to make a download conditional on the stored
+        copy having changed, if it was downloaded from the same URL."""
+
+        with self.lock:
+            entry = self.manifest[kind].get(key)
+        headers = {}
+        if entry and entry.get("url") == url:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("modified"):
+                headers["If-Modified-Since"] = entry["modified"]
+        return headers
+
+    def path(self, blob):
+        """Returns the path of a blob, which is fanned out into directories by
+        the first two characters of its hash."""
+
+        return f"{self.root}/blobs/{blob[:2]}/{blob}"
+
+    def add(self, response, kind, key, url):
+        """Streams a response body into the store and records it under kind and
+        key, keeping the stored copy on a 304 Not Modified. Returns the size,
+        or None, storing nothing, if the response wasn't successful."""
+
+        if response.status == 304:
+            with self.lock:
+                self.refreshed[(kind, key)] = False
+            return 0
+        if response.status != 200:
+            return None
+        digest = hashlib.sha256()
+        size = 0
+        temp = self.temp_path()
+        try:
+            with open(temp, "wb") as f:
+                while chunk := response.read(CHUNK_SIZE):
+                    bandwidth.acquire(len(chunk))
+                    digest.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+        except BaseException:
+            os.remove(temp)
+            raise
+        self.commit(temp, digest.hexdigest(), size, kind, key, url, response.headers)
+        return size
+
+    def temp_path(self):
+        """Returns a path in the store for a download to be written to before
+        its hash is known, unique to this process however many downloads are
+        in progress at once. It is a .part file until moved into place."""
+
+        temp = f"{self.root}/blobs/{os.getpid()}-{next(self.temp_names)}.part"
+        os.makedirs(os.path.dirname(temp), exist_ok=True)
+        return temp
+
+    def commit(self, temp, blob, size, kind, key, url, headers):
+        """Stores a finished download as the given blob, and records it under
+        kind and key with the response's validators."""
+
+        with self.lock:
+            previous = self.manifest[kind].get(key, {}).get("blob")
+            if kind != "files":
+                self.refreshed[(kind, key)] = previous is not None and previous != blob
+        self.store(temp, blob)
+        self.record(kind, key, blob, size, url, headers.get("ETag"), headers.get("Last-Modified"))
+
+    def store(self, filename, blob):
+        """Moves a file into the store as the given blob, or removes it if that
+        blob is already stored."""
+
+        path = self.path(blob)
+        if os.path.exists(path):
+            os.remove(filename)
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(filename, path)
+
+    def record(self, kind, key, blob, size, url=None, etag=None, modified=None):
+        """Records that something is stored as the given blob, appending it to
+        the manifest's log straight away so that it survives an interrupted
+        run."""
+
+        entry = {"blob": blob, "size": size, "url": url, "etag": etag, "modified": modified}
+        with self.lock:
+            self.manifest[kind][key] = entry
+            self.dirty = True
+            if self.root:
+                os.makedirs(self.root, exist_ok=True)
+                with open(f"{self.root}/manifest.log", "a") as f:
+                    f.write(json.dumps([kind, key, entry]) + "\n")
+
+    def log_refreshed(self):
+        """Logs how many images were checked for changes, and how many had
+        changed."""
+
+        if self.refresh and self.refreshed:
+            changed = sum(self.refreshed.values())
+            log(f"Checked {len(self.refreshed)} images for changes, {changed} had changed")
+
+    def import_legacy(self):
+        """Moves files saved by name, as {file_id}.{ext}, reactions/{name}.{ext}
+        and people/{id}.{ext}, into the store. Emoji and photos are recorded
+        without a URL, so they are downloaded again once to check they are
+        current."""
+
+        folders = {"files": self.root, "reactions": f"{self.root}/reactions", "people": f"{self.root}/people"}
+        moved = 0
+        for kind, folder in folders.items():
+            if not os.path.isdir(folder):
+                continue
+            for entry in os.scandir(folder):
+                if not entry.is_file() or entry.name.endswith(".part") or entry.name in ("manifest.log", "queue.log"):
+                    continue
+                digest = hashlib.sha256()
+                with open(entry.path, "rb") as f:
+                    while chunk := f.read(CHUNK_SIZE):
+                        digest.update(chunk)
+                size = entry.stat().st_size
+                self.store(entry.path, digest.hexdigest())
+                self.record(kind, entry.name.rsplit(".", 1)[0], digest.hexdigest(), size)
+                moved += 1
+        for folder in ("reactions", "people"):
+            if os.path.isdir(folders[folder]) and not os.listdir(folders[folder]):
+                os.rmdir(folders[folder])
+        if moved:
+            log(f"Moved {moved} downloaded files into the blob store")
+            self.save()
+
+
+blobs = BlobStore()
+
+
+def read_manifest_log(root):
+    """Yields the kind, key and entry of everything recorded in a blob store's
+    manifest log, oldest first, skipping a last line cut short by an
+    interrupted run."""
+
+    path = f"{root}/manifest.log"
+    if not os.path.exists(path):
+        return
+    with open(path) as f:
+        for line in f:
+            if not line.endswith("\n"):
+                break
+            yield json.loads(line)
+
+
+def read_queue_log(root):
+    """Returns what is left queued in a blob store's queue log, as a mapping of
+    kind and key to URL and label, skipping a last line cut short by an
+    interrupted run."""
+
+    queued = {}
+    path = f"{root}/queue.log"
+    if not os.path.exists(path):
+        return queued
+    with open(path) as f:
+        for line in f:
+            if not line.endswith("\n"):
+                break
+            action, kind, key, *rest = json.loads(line)
+            if action == "queued":
+                queued[(kind, key)] = tuple(rest)
+            else:
+                queued.pop((kind, key), None)
+    return queued
+
+
+class ConnectionPool:
+    """Keeps idle keep-alive connections for each host, so that requests don't
+    each pay for a new TCP and TLS handshake. A connection is only ever used
+    by one thread at a time, so the pool can be shared between threads.
+    Responses are returned whatever their status code rather than raised, and
+    redirects are followed. Connections go through the proxies set in the
+    environment, as urllib's would, and any idle for longer than
+    IDLE_TIMEOUT seconds are closed rather than reused."""
+
+    def __init__(self, timeout=REQUEST_TIMEOUT):
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.timeout = timeout
+        self.context = ssl.create_default_context()
+        self.proxies = urllib.request.getproxies()
+
+    def proxy(self, scheme, host):
+        """Returns the proxy to reach a host through, as split URL parts, or
+        None if there isn't one for its scheme or the host bypasses it."""
+
+        url = self.proxies.get(scheme)
+        if not url or urllib.request.proxy_bypass(host):
+            return None
+        proxy = urllib.parse.urlsplit(url if "://" in url else f"http://{url}")
+        if proxy.scheme != "http":
+            raise ValueError(f"Only http:// proxies are supported, not {url}")
+        return proxy
+
+    def checkout(self, scheme, host, proxy=None):
+        """Takes an idle connection to a host, or makes a new one, through the
+        proxy if one is given. Also returns whether the connection has been
+        used before."""
+
+        stale = []
+        with self.lock:
+            idle = self.idle.get((scheme, host), [])
+            while idle:
+                connection, returned = idle.pop()
+                if time.monotonic() - returned < IDLE_TIMEOUT:
+                    break
+                stale.append(connection)
+            else:
+                connection = None
+        for old in stale:
+            old.close()
+        if connection:
+            return connection, True
+        if not proxy:
+            if scheme == "https":
+                return http.client.HTTPSConnection(host, timeout=self.timeout, context=self.context), False
+            return http.client.HTTPConnection(host, timeout=self.timeout), False
+        if scheme == "https":
+            connection = http.client.HTTPSConnection(proxy.hostname, proxy.port or 80, timeout=self.timeout, context=self.context)
+            connection.set_tunnel(host, headers=proxy_headers(proxy))
+            return connection, False
+        return http.client.HTTPConnection(proxy.hostname, proxy.port or 80, timeout=self.timeout), False
+
+    def checkin(self, scheme, host, connection):
+        """Returns a connection to the pool once its response is finished."""
+
+        with self.lock:
+            idle = self.idle.setdefault((scheme, host), [])
+            if len(idle) < MAX_IDLE_CONNECTIONS:
+                idle.append((connection, time.monotonic()))
+                return
+        connection.close()
+
+    def request(self, method, url, body=None, headers=None, redirects=5):
+        """Makes a request, returning a PooledResponse which should be closed
+        (or used as a context manager) so its connection can be reused. If a
+        reused connection turns out to have been closed, or doesn't answer,
+        the request is retried once on a fresh one."""
+
+        parts = urllib.parse.urlsplit(url)
+        path = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+        proxy = self.proxy(parts.scheme, parts.netloc)
+        sent_headers = headers or {}
+        if proxy and parts.scheme == "http":
+            path = f"http://{parts.netloc}{path}"
+            sent_headers = {**sent_headers, **proxy_headers(proxy)}
+        while True:
+            connection, reused = self.checkout(parts.scheme, parts.netloc, proxy)
+            try:
+                connection.request(method, path, body=body, headers=sent_headers)
+                response = connection.getresponse()
+                break
+            except (http.client.HTTPException, ConnectionError, TimeoutError):
+                connection.close()
+                if not reused:
+                    raise
+        pooled = PooledResponse(self, parts.scheme, parts.netloc, connection, response)
+        location = response.getheader("Location")
+        if response.status in REDIRECT_STATUSES and location and redirects:
+            pooled.read()
+            pooled.close()
+            if response.status == 303 or (response.status in (301, 302) and method == "POST"):
+                method, body = "GET", None
+            return self.request(method, urllib.parse.urljoin(url, location), body, headers, redirects - 1)
+        return pooled
+
+
+def proxy_headers(proxy):
+    """Returns the headers to authenticate with a proxy, if its URL has a
+    username."""
+
+    if proxy.username is None:
+        return {}
+    credentials = f"{urllib.parse.unquote(proxy.username)}:{urllib.parse.unquote(proxy.password or '')}"
+    return {"Proxy-Authorization": f"Basic {base64.b64encode(credentials.encode()).decode()}"}
+
+
+class PooledResponse:
+    """A response from the connection pool. Its body can be read all at once
+    or in chunks, and is transparently decompressed if the server gzipped it.
+    Closing it hands the connection back to the pool if the body was read to
+    the end, and closes the connection otherwise."""
+
+    def __init__(self, pool, scheme, host, connection, response):
+        self.pool, self.scheme, self.host = pool, scheme, host
+        self.connection, self.response = connection, response
+        self.status = response.status
+        self.headers = response.headers
+        gzipped = (response.getheader("Content-Encoding") or "").lower() == "gzip"
+        self.decoder = zlib.decompressobj(16 + zlib.MAX_WBITS) if gzipped else None
+        self.buffer = b""
+
+    def read(self, amt=None):
+        """Reads up to amt bytes of the decoded body, or all of it."""
+
+        if not self.decoder:
+            return self.response.read(amt)
+        while amt is None or amt < 0 or len(self.buffer) < amt:
+            chunk = self.response.read(CHUNK_SIZE)
+            if not chunk:
+                self.buffer += self.decoder.flush()
+                break
+            self.buffer += self.decoder.decompress(chunk)
+        if amt is None or amt < 0:
+            amt = len(self.buffer)
+        content, self.buffer = self.buffer[:amt], self.buffer[amt:]
+        return content
+
+    def close(self):
+        """Hands the connection back to the pool, or closes it."""
+
+        if self.response.isclosed() and not self.response.will_close:
+            self.pool.checkin(self.scheme, self.host, self.connection)
+        else:
+            self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+pool = ConnectionPool()
+
+
+def slack_request(method, url, data, params=None, indent=1, headers=None, save=None):
     """Makes a request to the Slack API. It will handle ratelimiting,
-    authentication, and URL construction."""
+    authentication, and URL construction. If save is given, it is called with
+    the response to stream the body somewhere, and what it returns - the
+    number of bytes saved, or None - is returned instead of the body."""
 
-    global sleep_time
-    url = url if url.startswith("https://") else f"https://{data['workspace']}.slack.com/api/{url}"
-    if params:
-        url += ("&" if "?" in url else "?") + urllib.parse.urlencode(params)
-    headers = {"cookie": data["cookie"]}
+    api_method, url, label, headers, body = prepare_request(method, url, data, params, headers)
     while True:
-        if method == "POST":
-            body = urllib.parse.urlencode({"token": data["token"]}).encode()
-        else:
-            body = None
-        req = urllib.request.Request(
-            url,
-            data=body,
-            headers=headers,
-            method=method,
-        )
-        with opener.open(req) as response:
+        if api_method:
+            with stats.timed("rate_limit_wait"):
+                limiter.acquire(api_method)
+        started = time.monotonic()
+        with pool.request(method, url, body=body, headers=headers) as response:
+            if save:
+                return save_finished(label, started, save(response))
             content = response.read()
-        time.sleep(random.uniform(0.25, 0.75))
-        if method == "GET": return content
-        result = json.loads(content)
-        if result.get("error") == "ratelimited":
-            log(f"Ratelimited, sleeping for {sleep_time} seconds", indent=indent)
-            time.sleep(sleep_time)
-            sleep_time += 7
-            continue
-        return result
+            retry_after = response.headers.get("Retry-After")
+        retry, result = request_finished(method, api_method, label, started, content, retry_after, indent)
+        if not retry:
+            return result
+
+
+def prepare_request(method, url, data, params=None, headers=None):
+    """Works out everything about a request which doesn't depend on how it is
+    sent: the API method it is to, if any, the full URL, the label it is
+    recorded in the stats under, and the headers and body to send."""
+
+    api_method = None if url.startswith(("https://", "http://")) else url
+    if api_method:
+        base = data.get("api_url") or f"https://{data['workspace']}.slack.com/api"
+        url = f"{base}/{url}"
+    label = api_method or f"{method} {urllib.parse.urlsplit(url).netloc}"
+    if params:
+        url += ("&" if "?" in url else "?") + urllib.parse.urlencode(params)
+    headers = {"cookie": data["cookie"], "User-Agent": USER_AGENT, "Accept-Encoding": "gzip", **(headers or {})}
+    body = None
+    if method == "POST":
+        headers["Content-Type"] = "application/x-www-form-urlencoded"
+        body = urllib.parse.urlencode({"token": data["token"]}).encode()
+    return api_method, url, label, headers, body
+
+
+def save_finished(label, started, size):
+    """Records a request whose body was saved by a save function, returning
+    the number of bytes saved."""
+
+    stats.request(label, time.monotonic() - started, size or 0, failed=size is None)
+    return size
+
+
+def request_finished(method, api_method, label, started, content, retry_after=None, indent=1):
+    """Handles the body of a response to a request made at started: records
+    it in the stats, and for API methods parses it and tells the rate
+    limiter how it went. Returns whether the request should be made again
+    because it was ratelimited, and the body or the parsed result."""
+
+    if method == "GET":
+        stats.request(label, time.monotonic() - started, len(content))
+        return False, content
+    result = json.loads(content)
+    ratelimited = result.get("error") == "ratelimited"
+    stats.request(label, time.monotonic() - started, len(content), failed=result.get("ok") is False, retried=ratelimited)
+    if ratelimited:
+        wait = float(retry_after or DEFAULT_RETRY_AFTER)
+        log(f"Ratelimited on {api_method}, waiting {wait:g} seconds", indent=indent)
+        limiter.ratelimited(api_method, wait)
+        stats.add_time("retry_after", wait)
+        return True, None
+    limiter.succeeded(api_method)
+    return False, result
 
 
 def slack_post(*args, **kwargs):
@@ -382,18 +2161,39 @@ def slack_get(*args, **kwargs):
 def log(message, indent=0):
     """Logs a message to the console with some indentation."""
 
-    print(f"{'    ' * indent}{message}")
+    print(f"{getattr(log_context, 'prefix', '')}{'    ' * indent}{message}")
+
+
+@contextmanager
+def atomic_write(filename, mode="w"):
+    """Opens a temporary file next to filename for writing, and renames it
+    over filename once the block completes. If anything goes wrong the
+    temporary file is removed, so filename is never left half written."""
+
+    temp = f"{filename}.part"
+    try:
+        with open(temp, mode) as f:
+            yield f
+        os.replace(temp, filename)
+    except BaseException:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
 
 
 def load_output(output_path, data):
-    """Loads existing output from disk, or returns an empty structure."""
+    """Loads the existing index from disk, or returns an empty structure. The
+    index holds people, bots and channel metadata - channel messages are kept
+    in their own files and only read when needed, using load_messages. An
+    archive from before this layout, with everything in slack.json, is split
+    up the first time it is loaded."""
 
-    path = f"{output_path}/slack.json"
+    path = f"{output_path}/index.json"
     if os.path.exists(path):
         with open(path) as f:
-            output = json.load(f)
-        output.setdefault("bots", {})
-        return output
+            return json.load(f)
+    if os.path.exists(f"{output_path}/slack.json"):
+        return migrate_single_file(output_path)
     return {
         "id": data.get("id", ""),
         "name": data["workspace"],
@@ -403,13 +2203,102 @@ def load_output(output_path, data):
     }
 
 
+def migrate_single_file(output_path):
+    """Splits a slack.json archive into per-channel message files and an
+    index, returning the index. The original file is left where it is."""
+
+    log("Splitting slack.json into per-channel files")
+    with open(f"{output_path}/slack.json") as f:
+        output = json.load(f)
+    output.setdefault("bots", {})
+    for channel in output["channels"].values():
+        if "messages" in channel:
+            messages = channel.pop("messages")
+            save_channel(messages, output_path, channel["id"])
+            channel["message_count"] = len(messages)
+            if messages:
+                channel["latest_ts"] = messages[-1]["ts"]
+    save_output(output, output_path)
+    return output
+
+
 def save_output(output, output_path):
-    """Saves the output object to a JSON file."""
+    """Saves the index to a JSON file."""
 
     os.makedirs(output_path, exist_ok=True)
-    with open(f"{output_path}/slack.json", "w") as f:
+    with atomic_write(f"{output_path}/index.json") as f:
         json.dump(output, f, indent=4)
 
 
+def load_messages(output_path, channel_id):
+    """Loads the stored messages of a single channel, oldest first."""
+
+    return list(iter_messages(output_path, channel_id))
+
+
+def iter_messages(output_path, channel_id):
+    """Yields the stored messages of a single channel, oldest first, reading
+    them from disk one at a time."""
+
+    path = f"{output_path}/channels/{channel_id}.jsonl"
+    if not os.path.exists(path):
+        return
+    with open(path) as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def iter_messages_backwards(output_path, channel_id):
+    """Yields the stored messages of a single channel, newest first, reading
+    the file back from its end a chunk at a time, so that the newest
+    messages can be read without reading the rest."""
+
+    path = f"{output_path}/channels/{channel_id}.jsonl"
+    if not os.path.exists(path):
+        return
+    with open(path, "rb") as f:
+        position = f.seek(0, os.SEEK_END)
+        rest = b""
+        while position:
+            size = min(CHUNK_SIZE, position)
+            position -= size
+            f.seek(position)
+            lines = (f.read(size) + rest).split(b"\n")
+            rest = lines.pop(0)
+            for line in reversed(lines):
+                if line:
+                    yield json.loads(line)
+        if rest:
+            yield json.loads(rest)
+
+
+def save_channel(messages, output_path, channel_id):
+    """Saves the messages of a single channel to its own file, with one
+    message (and its replies) per line."""
+
+    os.makedirs(f"{output_path}/channels", exist_ok=True)
+    with atomic_write(f"{output_path}/channels/{channel_id}.jsonl") as f:
+        for message in messages:
+            f.write(json.dumps(message) + "\n")
+
+
+def export_single_file(output, output_path):
+    """Writes the whole archive to slack.json in the original single file
+    format, with each channel's messages inside it. Channels are written one
+    at a time, so only one channel's messages are in memory at once."""
+
+    log("Exporting to slack.json")
+    header = {key: value for key, value in output.items() if key != "channels"}
+    with atomic_write(f"{output_path}/slack.json") as f:
+        f.write(json.dumps(header, indent=4)[:-2] + ",\n    \"channels\": {")
+        for index, (channel_id, channel) in enumerate(output["channels"].items()):
+            channel = {key: value for key, value in channel.items() if key != "message_count"}
+            if "message_count" in output["channels"][channel_id]:
+                channel["messages"] = load_messages(output_path, channel_id)
+            nested = json.dumps(channel, indent=4).replace("\n", "\n        ")
+            f.write(f"{',' if index else ''}\n        {json.dumps(channel_id)}: {nested}")
+        f.write("\n    }\n}" if output["channels"] else "}\n}")
+
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
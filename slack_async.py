@@ -0,0 +1,276 @@
+import asyncio
+import http.client
+import io
+import ssl
+import time
+import urllib.parse
+import urllib.request
+import zlib
+from slack import (
+    CHUNK_SIZE, IDLE_TIMEOUT, MAX_IDLE_CONNECTIONS, REDIRECT_STATUSES, REQUEST_TIMEOUT, limiter, messages_page,
+    messages_page_request, prepare_request, request_finished, save_finished, stats,
+)
+
+MAX_CONNECTIONS = 64
+HEAD_LIMIT = 1024 * 1024
+
+
+async def slack_request(method, url, data, params=None, indent=1, headers=None, save=None):
+    """Makes a request to the Slack API from the event loop, as
+    slack.slack_request does from a thread, sharing its rate limiter and
+    stats. If save is given, it is awaited with the response to stream the
+    body somewhere, and should return the number of bytes saved, or None."""
+
+    api_method, url, label, headers, body = prepare_request(method, url, data, params, headers)
+    while True:
+        if api_method:
+            with stats.timed("rate_limit_wait"):
+                while wait := limiter.reserve(api_method):
+                    await asyncio.sleep(wait)
+        started = time.monotonic()
+        async with await pool.request(method, url, body=body, headers=headers) as response:
+            if save:
+                return save_finished(label, started, await save(response))
+            content = await response.read()
+            retry_after = response.headers.get("Retry-After")
+        retry, result = request_finished(method, api_method, label, started, content, retry_after, indent)
+        if not retry:
+            return result
+
+
+async def slack_post(*args, **kwargs):
+    """Makes a POST request to the Slack API."""
+
+    return await slack_request("POST", *args, **kwargs)
+
+
+async def slack_get(*args, **kwargs):
+    """Makes a GET request to the Slack API."""
+
+    return await slack_request("GET", *args, **kwargs)
+
+
+async def get_messages_page(channel_id, data, latest_ts=None, reply_ts=None, oldest_ts=None, cursor=None):
+    """Gets a single page of messages for a particular channel, as
+    slack.get_messages_page does. It returns the messages along with the
+    cursor for the next page, which is empty if this was the last one."""
+
+    path, params = messages_page_request(channel_id, latest_ts, reply_ts, oldest_ts, cursor)
+    return messages_page(await slack_post(path, data, params=params), reply_ts)
+
+
+class AsyncConnectionPool:
+    """Keeps idle keep-alive connections for each host, as
+    slack.ConnectionPool does, made with asyncio streams. At most
+    max_connections are open to a host at once, and further requests wait
+    for one to be handed back. Responses are returned whatever their status
+    code rather than raised, and redirects are followed. Proxies aren't
+    supported, so requests to a host with one set in the environment are
+    refused. The pool belongs to the event loop it is first used in, and
+    should be closed before that loop is."""
+
+    def __init__(self, max_connections=MAX_CONNECTIONS, timeout=REQUEST_TIMEOUT):
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.idle = {}
+        self.slots = {}
+        self.context = ssl.create_default_context()
+        self.proxies = urllib.request.getproxies()
+
+    async def checkout(self, parts):
+        """Takes an idle connection to a URL's host, or makes a new one, once
+        one of the host's slots is free. Also returns whether the connection
+        has been used before. Connections idle for longer than IDLE_TIMEOUT
+        seconds are closed rather than reused."""
+
+        key = (parts.scheme, parts.netloc)
+        if self.proxies.get(parts.scheme) and not urllib.request.proxy_bypass(parts.netloc):
+            raise ValueError(f"slack_async can't connect through the proxy set for {parts.scheme} - use slack.py instead")
+        await self.slots.setdefault(key, asyncio.Semaphore(self.max_connections)).acquire()
+        idle = self.idle.get(key, [])
+        while idle:
+            connection, returned = idle.pop()
+            if time.monotonic() - returned < IDLE_TIMEOUT:
+                return connection, True
+            connection[1].close()
+        try:
+            https = parts.scheme == "https"
+            connection = await asyncio.wait_for(asyncio.open_connection(
+                parts.hostname, parts.port or (443 if https else 80), ssl=self.context if https else None, limit=HEAD_LIMIT,
+            ), self.timeout)
+        except BaseException:
+            self.slots[key].release()
+            raise
+        return connection, False
+
+    def checkin(self, key, connection):
+        """Returns a connection to the pool once its response is finished."""
+
+        idle = self.idle.setdefault(key, [])
+        if len(idle) < MAX_IDLE_CONNECTIONS:
+            idle.append((connection, time.monotonic()))
+        else:
+            connection[1].close()
+        self.slots[key].release()
+
+    def discard(self, key, connection):
+        """Closes a connection which can't be reused."""
+
+        connection[1].close()
+        self.slots[key].release()
+
+    def close(self):
+        """Closes every idle connection."""
+
+        idle, self.idle = self.idle, {}
+        for connections in idle.values():
+            for (reader, writer), returned in connections:
+                writer.close()
+
+    async def request(self, method, url, body=None, headers=None, redirects=5):
+        """Makes a request, returning an AsyncResponse which should be closed
+        (or used as an async context manager) so its connection can be reused.
+        If a reused connection turns out to have been closed, or doesn't
+        answer, the request is retried once on a fresh one."""
+
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+        head = f"{method} {path} HTTP/1.1\r\nHost: {parts.netloc}\r\n"
+        head += "".join(f"{name}: {value}\r\n" for name, value in (headers or {}).items())
+        if body is not None:
+            head += f"Content-Length: {len(body)}\r\n"
+        payload = f"{head}\r\n".encode("latin-1") + (body or b"")
+        while True:
+            connection, reused = await self.checkout(parts)
+            try:
+                connection[1].write(payload)
+                await connection[1].drain()
+                status, response_headers = await asyncio.wait_for(read_head(connection[0]), self.timeout)
+                break
+            except BaseException as e:
+                self.discard(key, connection)
+                if not reused or not isinstance(e, (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError)):
+                    raise
+        response = AsyncResponse(self, key, connection, method, status, response_headers)
+        location = response_headers.get("Location")
+        if status in REDIRECT_STATUSES and location and redirects:
+            await response.read()
+            response.close()
+            if status == 303 or (status in (301, 302) and method == "POST"):
+                method, body = "GET", None
+            return await self.request(method, urllib.parse.urljoin(url, location), body, headers, redirects - 1)
+        return response
+
+
+async def read_head(reader):
+    """Reads the status line and headers of a response, returning the status
+    code and the headers as an http.client.HTTPMessage."""
+
+    head = await reader.readuntil(b"\r\n\r\n")
+    status_line, _, header_lines = head.partition(b"\r\n")
+    fields = status_line.split(None, 2)
+    if len(fields) < 2 or not fields[0].startswith(b"HTTP/") or not fields[1].isdigit():
+        raise http.client.BadStatusLine(status_line.decode("latin-1"))
+    return int(fields[1]), http.client.parse_headers(io.BytesIO(header_lines))
+
+
+class AsyncResponse:
+    """A response from the asyncio connection pool, as slack.PooledResponse
+    is from the thread-safe one. Its body is framed by its Content-Length,
+    chunked encoding, or the connection closing, and is transparently
+    decompressed if the server gzipped it. Closing it hands the connection
+    back to the pool if the body was read to the end, and closes the
+    connection otherwise."""
+
+    def __init__(self, pool, key, connection, method, status, headers):
+        self.pool, self.key, self.connection = pool, key, connection
+        self.status = status
+        self.headers = headers
+        self.chunked = "chunked" in (headers.get("Transfer-Encoding") or "").lower()
+        length = headers.get("Content-Length")
+        if method == "HEAD" or status in (204, 304) or status < 200:
+            self.remaining = 0
+        elif self.chunked or length is None:
+            self.remaining = None
+        else:
+            self.remaining = int(length)
+        self.will_close = (headers.get("Connection") or "").lower() == "close" or (self.remaining is None and not self.chunked)
+        self.finished = self.remaining == 0
+        self.chunk_left = 0
+        gzipped = (headers.get("Content-Encoding") or "").lower() == "gzip"
+        self.decoder = zlib.decompressobj(16 + zlib.MAX_WBITS) if gzipped else None
+        self.buffer = b""
+
+    async def read_raw(self, amt):
+        """Reads up to amt bytes of the body as sent, or nothing at its end."""
+
+        reader = self.connection[0]
+        if self.finished:
+            return b""
+        if self.chunked:
+            if not self.chunk_left:
+                self.chunk_left = int((await reader.readline()).split(b";")[0], 16)
+                if not self.chunk_left:
+                    while (await reader.readline()).strip():
+                        pass
+                    self.finished = True
+                    return b""
+            content = await reader.read(min(amt, self.chunk_left))
+            if not content:
+                raise asyncio.IncompleteReadError(b"", self.chunk_left)
+            self.chunk_left -= len(content)
+            if not self.chunk_left:
+                await reader.readexactly(2)
+            return content
+        if self.remaining is None:
+            content = await reader.read(amt)
+            self.finished = not content
+            return content
+        content = await reader.read(min(amt, self.remaining))
+        if not content:
+            raise asyncio.IncompleteReadError(b"", self.remaining)
+        self.remaining -= len(content)
+        self.finished = not self.remaining
+        return content
+
+    async def read(self, amt=None):
+        """Reads up to amt bytes of the decoded body, or all of it."""
+
+        if not self.decoder:
+            if amt is not None and amt >= 0:
+                return await self.read_raw(amt)
+            chunks = []
+            while chunk := await self.read_raw(CHUNK_SIZE):
+                chunks.append(chunk)
+            return b"".join(chunks)
+        while amt is None or amt < 0 or len(self.buffer) < amt:
+            chunk = await self.read_raw(CHUNK_SIZE)
+            if not chunk:
+                self.buffer += self.decoder.flush()
+                break
+            self.buffer += self.decoder.decompress(chunk)
+        if amt is None or amt < 0:
+            amt = len(self.buffer)
+        content, self.buffer = self.buffer[:amt], self.buffer[amt:]
+        return content
+
+    def close(self):
+        """Hands the connection back to the pool, or closes it."""
+
+        if self.connection is None:
+            return
+        if self.finished and not self.will_close:
+            self.pool.checkin(self.key, self.connection)
+        else:
+            self.pool.discard(self.key, self.connection)
+        self.connection = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        self.close()
+
+
+pool = AsyncConnectionPool()
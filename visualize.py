@@ -1,70 +1,199 @@
 import argparse
 import json
-from datetime import datetime, timedelta
+import os
+import re
+from datetime import datetime
+import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
+from archive import Archive
+from slack import atomic_write
+
+DENSITY_THRESHOLD = 5000
+DENSITY_BINS = 400
+SECTION_LINE = re.compile(r'^ {4}"([^"]+)": ')
+CHANNEL_LINE = re.compile(r'^ {8}("(?:[^"\\]|\\.)*"): \{$')
+NAME_LINE = re.compile(r'^ {12}"readable_name": ("(?:[^"\\]|\\.)*"),?$')
+MESSAGES_LINE = re.compile(r'^ {12}"messages": \[')
+TS_LINE = re.compile(r'^ {20}"ts": "([0-9.]+)",?$')
 
 
 def main():
-    data, title = parse_args()
-    plot_channel_timeline(data, title=title)
+    data, title, density_threshold = parse_args()
+    plot_channel_timeline(data, title=title, density_threshold=density_threshold)
     plt.show()
 
 
 def parse_args():
-    """Parses the CLI arguments to produce the thread timestamp data and plot
-    title."""
+    """Parses the CLI arguments to produce the thread timestamp data, plot
+    title and density threshold."""
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("data_path", type=str)
+    parser.add_argument("data_path", type=str, help="An output directory, or a slack.json file")
     parser.add_argument("--title", type=str, default="Channel Timeline", help="Title for the plot")
+    parser.add_argument("--density-threshold", type=int, default=DENSITY_THRESHOLD, help="Channels with more messages than this are drawn as a density strip rather than dots")
     args = parser.parse_args()
-    with open(args.data_path) as f:
-        jdata = json.load(f)
-    data = extract_timestamps(jdata)
-    return data, args.title
+    data = load_timestamps(args.data_path)
+    return data, args.title, args.density_threshold
+
+
+def load_timestamps(path):
+    """Loads the timestamps of every downloaded channel in an archive, either
+    an output directory written by slack.py or a single slack.json file, as a
+    mapping of channel names to NumPy arrays of unix timestamps. Only names
+    and timestamps are extracted, and they are cached in a sidecar file next
+    to the archive, which is used for as long as the archive is unchanged."""
+
+    if os.path.isdir(path):
+        cache_path, source = f"{path}/timestamps.npz", f"{path}/index.json"
+    else:
+        cache_path, source = f"{path}.timestamps.npz", path
+    key = os.stat(source).st_mtime_ns
+    if os.path.exists(cache_path):
+        with np.load(cache_path) as cache:
+            if int(cache["key"]) == key:
+                return unpack_timestamps(cache["names"], cache["offsets"], cache["timestamps"])
+    if os.path.isdir(path):
+        data = extract_directory_timestamps(path)
+    else:
+        data = extract_file_timestamps(path)
+    try:
+        with atomic_write(cache_path, "wb") as f:
+            np.savez(f, key=np.int64(key), **pack_timestamps(data))
+    except OSError:
+        pass
+    return data
+
+
+def pack_timestamps(data):
+    """Packs a mapping of channel names to timestamp arrays into three flat
+    arrays: the names, the offset of each channel's timestamps, and all the
+    timestamps one channel after another."""
+
+    arrays = list(data.values())
+    return {
+        "names": np.array(list(data.keys()), dtype=str),
+        "offsets": np.cumsum([0] + [len(array) for array in arrays], dtype=np.int64),
+        "timestamps": np.concatenate(arrays) if arrays else np.empty(0),
+    }
+
+
+def unpack_timestamps(names, offsets, timestamps):
+    """Unpacks the arrays made by pack_timestamps."""
+
+    return {
+        str(name): timestamps[offsets[index]:offsets[index + 1]]
+        for index, name in enumerate(names)
+    }
+
+
+def extract_directory_timestamps(path):
+    """Extracts timestamps from an output directory, reading each channel's
+    file a message at a time."""
+
+    archive = Archive(path)
+    return {
+        archive.channels[channel_id].get("readable_name", channel_id): np.fromiter(
+            (float(message["ts"]) for message in archive.messages(channel_id)), dtype=float
+        )
+        for channel_id in archive.downloaded()
+    }
+
+
+def extract_file_timestamps(path):
+    """Extracts timestamps from a slack.json file a line at a time, relying on
+    the four-space indentation slack.py writes it with to pick out channel
+    names and message timestamps without parsing anything else. Files laid
+    out any other way are loaded whole instead."""
+
+    names, timestamps = {}, {}
+    channel_id = None
+    in_channels = False
+    with open(path) as f:
+        for line in f:
+            if match := TS_LINE.match(line):
+                if channel_id in timestamps:
+                    timestamps[channel_id].append(float(match.group(1)))
+            elif match := SECTION_LINE.match(line):
+                in_channels = match.group(1) == "channels"
+                channel_id = None
+            elif in_channels and (match := CHANNEL_LINE.match(line)):
+                channel_id = json.loads(match.group(1))
+            elif channel_id is not None and (match := NAME_LINE.match(line)):
+                names[channel_id] = json.loads(match.group(1))
+            elif channel_id is not None and MESSAGES_LINE.match(line):
+                timestamps[channel_id] = []
+    if not names:
+        with open(path) as f:
+            return extract_timestamps(json.load(f))
+    return {
+        names.get(channel_id, channel_id): np.array(values, dtype=float)
+        for channel_id, values in timestamps.items()
+    }
 
 
 def extract_timestamps(jdata):
     """Extracts timestamps from the thread data, returning a mapping of thread
-    names to lists of unix timestamps."""
+    names to arrays of unix timestamps."""
 
     return {
-        channel["readable_name"]: [float(m["ts"]) for m in channel["messages"]]
+        channel["readable_name"]: np.array([float(m["ts"]) for m in channel["messages"]], dtype=float)
         for channel in jdata["channels"].values()
         if "messages" in channel
     }
 
 
 def parse_timestamps(timestamps):
-    """Parses a list of timestamps into datetime objects. Supports datetime
+    """Parses a sequence of timestamps into a NumPy datetime64 array, in local
+    time. Arrays of unix timestamps are converted in one go, and datetime
+    objects and ISO format strings are also supported. The UTC offset is
+    looked up once for each hour the timestamps fall in, so that it follows
+    daylight saving changes without a lookup per timestamp."""
+
+    if isinstance(timestamps, np.ndarray) and timestamps.dtype.kind in "iuf":
+        seconds = timestamps.astype(float)
+    else:
+        seconds = np.array([parse_timestamp(ts) for ts in timestamps], dtype=float)
+    hours, inverse = np.unique(np.floor(seconds / 3600), return_inverse=True)
+    offsets = np.array([utc_offset(hour * 3600) for hour in hours], dtype=float)
+    seconds = seconds + offsets[inverse.reshape(-1)]
+    return (seconds * 1e6).astype("datetime64[us]")
+
+
+def utc_offset(seconds):
+    """Returns the local UTC offset at a unix timestamp, in seconds."""
+
+    return datetime.fromtimestamp(seconds).astimezone().utcoffset().total_seconds()
+
+
+def parse_timestamp(ts):
+    """Parses a single timestamp into a unix timestamp. Supports datetime
     objects, ISO format strings, and unix timestamps."""
 
-    parsed = []
-    for ts in timestamps:
-        if isinstance(ts, datetime):
-            parsed.append(ts)
-        elif isinstance(ts, str):
-            parsed.append(datetime.fromisoformat(ts.replace('Z', '+00:00')))
-        elif isinstance(ts, (int, float)):
-            parsed.append(datetime.fromtimestamp(ts))
-        else:
-            raise ValueError(f"Unsupported timestamp format: {type(ts)}")
-    return parsed
+    if isinstance(ts, datetime):
+        return ts.timestamp()
+    elif isinstance(ts, str):
+        return datetime.fromisoformat(ts.replace('Z', '+00:00')).timestamp()
+    elif isinstance(ts, (int, float, np.number)):
+        return float(ts)
+    else:
+        raise ValueError(f"Unsupported timestamp format: {type(ts)}")
 
 
-def plot_channel_timeline(data, figsize=(12, 6), title="Channel Timeline"):
+def plot_channel_timeline(data, figsize=(12, 6), title="Channel Timeline", density_threshold=DENSITY_THRESHOLD):
     """Plots timestamps for multiple channels as vertically stacked horizontal
-    lines with scatter dots."""
+    lines with scatter dots. Channels with more than density_threshold
+    messages are drawn as a strip shaded by how many messages were sent when
+    instead."""
 
     parsed_data = {channel: parse_timestamps(timestamps) for channel, timestamps in data.items()}
 
-    all_timestamps = [ts for timestamps in parsed_data.values() for ts in timestamps]
-    if not all_timestamps:
+    non_empty = [timestamps for timestamps in parsed_data.values() if timestamps.size]
+    if not non_empty:
         raise ValueError("No timestamps provided")
 
-    min_time = min(all_timestamps)
-    max_time = max(all_timestamps)
+    min_time = min(timestamps.min() for timestamps in non_empty)
+    max_time = max(timestamps.max() for timestamps in non_empty)
 
     channels = list(parsed_data.keys())
     n_channels = len(channels)
@@ -74,7 +203,9 @@ def plot_channel_timeline(data, figsize=(12, 6), title="Channel Timeline"):
 
     for idx, (channel, timestamps) in enumerate(parsed_data.items()):
         ax = axes[idx]
-        plot_channel_row(ax, channel, timestamps, idx, n_channels)
+        if timestamps.size > density_threshold:
+            plot_channel_density(ax, timestamps, min_time, max_time)
+        plot_channel_row(ax, channel, timestamps if timestamps.size <= density_threshold else None, idx, n_channels)
 
     format_x_axis(axes[-1], min_time, max_time)
     fig.suptitle(title, fontweight='bold', fontsize=14)
@@ -93,15 +224,15 @@ def label_fontsize(label, base=10, min_size=6):
 
 
 def plot_channel_row(ax, channel, timestamps, idx, n_channels):
-    """Plots a single channel row with a horizontal baseline and scatter dots
-    for each timestamp."""
+    """Plots a single channel row with a horizontal baseline and, unless
+    timestamps is None, dots for each timestamp, drawn as a single set of
+    markers."""
 
     ax.axhline(y=0, color='lightgray', linewidth=1, zorder=1)
 
-    if timestamps:
-        y_values = [0] * len(timestamps)
-        ax.scatter(timestamps, y_values, s=30, c='steelblue', zorder=2, edgecolors='white', linewidth=1)
-        ax.scatter(timestamps, y_values, s=30, c='steelblue', zorder=2, edgecolors='none')
+    if timestamps is not None and timestamps.size:
+        ax.plot(timestamps, np.zeros(timestamps.size), linestyle='none', marker='o', markersize=5,
+                markerfacecolor='steelblue', markeredgecolor='white', markeredgewidth=1, zorder=2)
 
     label = channel or "<self>"
     fontsize = label_fontsize(label)
@@ -117,17 +248,30 @@ def plot_channel_row(ax, channel, timestamps, idx, n_channels):
         ax.tick_params(bottom=False)
 
 
+def plot_channel_density(ax, timestamps, min_time, max_time, bins=DENSITY_BINS):
+    """Plots a channel's timestamps as a strip of bins across the whole time
+    range, each shaded by how many messages fall in it."""
+
+    start, end = mdates.date2num(min_time), mdates.date2num(max_time)
+    if end <= start:
+        end = start + 1 / 1440
+    counts, _ = np.histogram(mdates.date2num(timestamps), bins=bins, range=(start, end))
+    shades = np.ma.masked_equal(counts, 0)[np.newaxis, :]
+    ax.imshow(shades, aspect='auto', cmap='Blues', interpolation='nearest',
+              extent=(start, end, -0.25, 0.25), vmin=0, zorder=2)
+
+
 def format_x_axis(ax, min_time, max_time):
     """Formats the x-axis of the bottom subplot with date labels and
     appropriate padding."""
 
+    ax.xaxis_date()
     ax.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d'))
     plt.xticks(rotation=45, ha='right')
 
-    time_range = (max_time - min_time).total_seconds()
-    padding = max(time_range * 0.05, 60)
-    ax.set_xlim(min_time - timedelta(seconds=padding),
-                max_time + timedelta(seconds=padding))
+    time_range = (max_time - min_time) / np.timedelta64(1, 's')
+    padding = np.timedelta64(int(max(time_range * 0.05, 60)), 's')
+    ax.set_xlim(min_time - padding, max_time + padding)
 
 
 if __name__ == "__main__":